@@ -1,8 +1,11 @@
 from config.api import *
 from config.prompts_chara import *
+from config.core_config import core_config
 import json
 import os
+import copy
 import logging
+import threading
 
 # Setup logger for this module
 logger = logging.getLogger(__name__)
@@ -27,7 +30,20 @@ _default_vtuber = {
 }
 
 
-def load_characters(character_json_path=CHARACTER_JSON_PATH):
+# 角色配置缓存：按文件 (mtime_ns, size) 失效，热路径上不再读盘
+_character_cache = {"sig": False, "data": None, "snapshot": None}
+_character_cache_lock = threading.RLock()
+
+
+def _character_file_sig():
+    try:
+        st = os.stat(CHARACTER_JSON_PATH)
+        return st.st_mtime_ns, st.st_size
+    except OSError:
+        return None
+
+
+def _read_characters():
     try:
         with open(CHARACTER_JSON_PATH, 'r', encoding='utf-8') as f:
             character_data = json.load(f)
@@ -39,12 +55,36 @@ def load_characters(character_json_path=CHARACTER_JSON_PATH):
         character_data = {"主人": _default_master, "Vtuber": _default_vtuber}
     return character_data
 
+
+def _cached_characters():
+    """返回 (原始配置, get_character_data 快照)，文件变化时重新解析。调用方不得修改返回值。"""
+    with _character_cache_lock:
+        sig = _character_file_sig()
+        if _character_cache["sig"] != sig:
+            data = _read_characters()
+            _character_cache.update(sig=sig, data=data, snapshot=_build_character_snapshot(data))
+        return _character_cache["data"], _character_cache["snapshot"]
+
+
+def reload_character_data():
+    """丢弃缓存，下次读取时重新解析 characters.json。角色管理接口修改配置后调用。"""
+    with _character_cache_lock:
+        _character_cache.update(sig=False, data=None, snapshot=None)
+
+
+def load_characters(character_json_path=CHARACTER_JSON_PATH):
+    # 返回副本，调用方可以自由修改后再 save_characters
+    return copy.deepcopy(_cached_characters()[0])
+
 def save_characters(data, character_json_path=CHARACTER_JSON_PATH):
-    with open(character_json_path, 'w', encoding='utf-8') as f:
+    # 先写临时文件再原子替换，避免并发读到半个文件
+    tmp_path = f"{character_json_path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
         json.dump(data, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, character_json_path)
+    reload_character_data()
 
-def get_character_data():
-    character_data = load_characters()
+def _build_character_snapshot(character_data):
     # MASTER_NAME 必须始终存在，取档案名
     MASTER_NAME = character_data.get('主人', {}).get('档案名', _default_master['档案名'])
 
@@ -62,8 +102,13 @@ def get_character_data():
         her_name = catgirl_names[0] if catgirl_names else ''
         # 如果没有设置当前角色，自动设置第一个为当前角色
         if her_name and not current_catgirl:
+            character_data = copy.deepcopy(character_data)
             character_data[current_field] = her_name
-            save_characters(character_data)
+            # 只写文件，缓存由下一次读取时的 mtime 变化刷新
+            tmp_path = f"{CHARACTER_JSON_PATH}.tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(character_data, f, ensure_ascii=False, indent=2)
+            os.replace(tmp_path, CHARACTER_JSON_PATH)
 
     master_basic_config = character_data.get('主人', _default_master)
     lanlan_basic_config = roles if catgirl_names else _default_vtuber
@@ -78,12 +123,18 @@ def get_character_data():
 
     return MASTER_NAME, her_name, master_basic_config, lanlan_basic_config, NAME_MAPPING, LANLAN_PROMPT, SEMANTIC_STORE, TIME_STORE, SETTING_STORE, RECENT_LOG
 
+def get_character_data():
+    # 快照本身不可变；调用方常会就地修改 name_mapping 等字典，所以每次返回一份副本
+    return copy.deepcopy(_cached_characters()[1])
+
 TIME_ORIGINAL_TABLE_NAME = "time_indexed_original"
 TIME_COMPRESSED_TABLE_NAME = "time_indexed_compressed"
+TIME_DAILY_TABLE_NAME = "time_indexed_daily"
 
 try:
-    with open('./config/core_config.json', 'r', encoding='utf-8') as f:
-        core_cfg = json.load(f)
+    if not core_config.exists():
+        raise FileNotFoundError(core_config.path)
+    core_cfg = core_config.snapshot()
     if 'coreApiKey' in core_cfg and core_cfg['coreApiKey'] and core_cfg['coreApiKey'] != CORE_API_KEY:
         logger.warning("coreApiKey in core_config.json is updated. Overwriting CORE_API_KEY.")
         CORE_API_KEY = core_cfg['coreApiKey']
@@ -0,0 +1,104 @@
+import os
+import json
+import copy
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+CORE_CONFIG_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'core_config.json')
+
+
+class CoreConfig:
+    """
+    core_config.json 的统一读写入口。
+    - 读取走内存缓存，文件 (mtime_ns, size) 变化时自动重新加载，其他进程的修改也能被看到
+    - 写入只合并传入的键，并先写临时文件再原子替换，不同写入方不会互相覆盖对方的字段
+    """
+
+    def __init__(self, path=CORE_CONFIG_PATH):
+        self.path = path
+        self._lock = threading.RLock()
+        self._sig = False
+        self._data = {}
+
+    def _stat(self):
+        try:
+            st = os.stat(self.path)
+            return st.st_mtime_ns, st.st_size
+        except OSError:
+            return None
+
+    def _reload_if_changed(self):
+        sig = self._stat()
+        if sig == self._sig:
+            return
+        with self._lock:
+            if sig == self._sig:
+                return
+            data = {}
+            if sig is not None:
+                try:
+                    with open(self.path, 'r', encoding='utf-8') as f:
+                        data = json.load(f)
+                except Exception as e:
+                    # 文件损坏时保留上一次成功加载的内容，直到文件再次变化
+                    logger.error(f"读取 {self.path} 失败: {e}")
+                    self._sig = sig
+                    return
+            self._data = data if isinstance(data, dict) else {}
+            self._sig = sig
+
+    def reload(self):
+        """强制下次读取时重新加载（例如手动编辑了配置文件）。"""
+        with self._lock:
+            self._sig = False
+        self._reload_if_changed()
+
+    def exists(self):
+        return self._stat() is not None
+
+    def snapshot(self):
+        """返回当前配置的副本。"""
+        self._reload_if_changed()
+        return copy.deepcopy(self._data)
+
+    def get(self, key, default=None):
+        self._reload_if_changed()
+        value = self._data.get(key, default)
+        return copy.deepcopy(value) if isinstance(value, (dict, list)) else value
+
+    def get_bool(self, key, default=False):
+        value = self.get(key, None)
+        return default if value is None else bool(value)
+
+    def get_int(self, key, default=None, minimum=None):
+        try:
+            value = int(self.get(key, default))
+        except (TypeError, ValueError):
+            return default
+        if minimum is not None and value < minimum:
+            return default
+        return value
+
+    def get_str(self, key, default=''):
+        value = self.get(key, None)
+        return default if value is None else str(value)
+
+    def update(self, values):
+        """把 values 合并写入配置文件。写之前重新读一次磁盘，避免覆盖其他进程刚写入的字段。"""
+        with self._lock:
+            self._sig = False
+            self._reload_if_changed()
+            data = copy.deepcopy(self._data)
+            data.update(values)
+            tmp_path = f"{self.path}.tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(data, f, ensure_ascii=False, indent=2)
+            os.replace(tmp_path, self.path)
+            self._data = data
+            self._sig = self._stat()
+        return self.snapshot()
+
+
+core_config = CoreConfig()
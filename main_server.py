@@ -38,9 +38,10 @@ import subprocess
 import httpx
 import pathlib, wave
 from openai import AsyncOpenAI
-from config import get_character_data, MAIN_SERVER_PORT, CORE_API_KEY, AUDIO_API_KEY, EMOTION_MODEL, OPENROUTER_API_KEY, OPENROUTER_URL, load_characters, save_characters, TOOL_SERVER_PORT, MONITOR_SERVER_PORT
+from config import get_character_data, MAIN_SERVER_PORT, CORE_API_KEY, AUDIO_API_KEY, EMOTION_MODEL, OPENROUTER_API_KEY, OPENROUTER_URL, load_characters, save_characters, reload_character_data, TOOL_SERVER_PORT, MONITOR_SERVER_PORT
 from utils.model_path import normalize_vrm_path, validate_character_config
 from config.prompts_sys import emotion_analysis_prompt
+from config.core_config import core_config
 import glob
 
 templates = Jinja2Templates(directory="./")
@@ -419,11 +420,10 @@ async def get_core_config():
     """获取核心配置（API Key）"""
     try:
         # 尝试从core_config.json读取
-        try:
-            with open('./config/core_config.json', 'r', encoding='utf-8') as f:
-                core_cfg = json.load(f)
-                api_key = core_cfg.get('coreApiKey', '')
-        except FileNotFoundError:
+        if core_config.exists():
+            core_cfg = core_config.snapshot()
+            api_key = core_cfg.get('coreApiKey', '')
+        else:
             # 如果文件不存在，返回当前内存中的CORE_API_KEY
             api_key = CORE_API_KEY
             core_cfg = {}
@@ -446,6 +446,12 @@ async def get_core_config():
         }
 
 
+@app.post("/api/config/reload")
+async def reload_core_config():
+    """手动编辑 core_config.json 后强制重新加载"""
+    core_config.reload()
+    return {"success": True}
+
 @app.post("/api/config/core_api")
 async def update_core_config(request: Request):
     """更新核心配置（API Key）"""
@@ -485,8 +491,7 @@ async def update_core_config(request: Request):
             core_cfg['ollamaModel'] = data['ollamaModel']
         if 'ollamaUrl' in data:
             core_cfg['ollamaUrl'] = data['ollamaUrl']
-        with open('./config/core_config.json', 'w', encoding='utf-8') as f:
-            json.dump(core_cfg, f, indent=2, ensure_ascii=False)
+        core_config.update(core_cfg)
         
         return {"success": True, "message": "API Key已保存"}
     except Exception as e:
@@ -495,12 +500,7 @@ async def update_core_config(request: Request):
 @app.get('/api/ollama/models')
 async def api_ollama_models():
     try:
-        try:
-            with open('./config/core_config.json', 'r', encoding='utf-8') as f:
-                core_cfg = json.load(f)
-        except FileNotFoundError:
-            core_cfg = {}
-        base = core_cfg.get('ollamaUrl', 'http://127.0.0.1:11434')
+        base = core_config.get_str('ollamaUrl', 'http://127.0.0.1:11434')
         async with httpx.AsyncClient(timeout=httpx.Timeout(5.0)) as client:
             r = await client.get(f"{base}/api/tags")
             data = r.json()
@@ -687,6 +687,7 @@ async def api_admin_flush_cache():
         os.makedirs(store_dir, exist_ok=True)
         patterns = [
             os.path.join(store_dir, 'recent_*.json'),
+            os.path.join(store_dir, 'recent_*.journal.jsonl'),
             os.path.join(store_dir, 'settings_*.json'),
             os.path.join(store_dir, 'semantic_memory_*'),
             os.path.join(store_dir, 'time_indexed_*'),
@@ -990,6 +991,12 @@ async def api_key_settings(request: Request):
 async def get_characters():
     return JSONResponse(content=load_characters())
 
+@app.post('/api/characters/reload')
+async def reload_characters():
+    """手动编辑 characters.json 后，强制丢弃角色配置缓存"""
+    reload_character_data()
+    return {"success": True}
+
 @app.get('/api/characters/current_catgirl')
 async def get_current_catgirl():
     """获取当前使用的角色名称（兼容旧字段）"""
@@ -1414,15 +1421,8 @@ async def get_recent_files():
 async def get_review_config():
     """获取记忆审阅配置"""
     try:
-        config_path = './config/core_config.json'
-        if os.path.exists(config_path):
-            with open(config_path, 'r', encoding='utf-8') as f:
-                config_data = json.load(f)
-                # 如果配置中没有这个键，默认返回True（开启）
-                return {"enabled": config_data.get('recent_memory_auto_review', True)}
-        else:
-            # 如果配置文件不存在，默认返回True（开启）
-            return {"enabled": True}
+        # 配置文件或键不存在时，默认返回True（开启）
+        return {"enabled": core_config.get('recent_memory_auto_review', True)}
     except Exception as e:
         logger.error(f"读取记忆审阅配置失败: {e}")
         return {"enabled": True}
@@ -1434,20 +1434,8 @@ async def update_review_config(request: Request):
         data = await request.json()
         enabled = data.get('enabled', True)
         
-        config_path = './config/core_config.json'
-        config_data = {}
-        
-        # 读取现有配置
-        if os.path.exists(config_path):
-            with open(config_path, 'r', encoding='utf-8') as f:
-                config_data = json.load(f)
-        
-        # 更新配置
-        config_data['recent_memory_auto_review'] = enabled
-        
-        # 保存配置
-        with open(config_path, 'w', encoding='utf-8') as f:
-            json.dump(config_data, f, ensure_ascii=False, indent=2)
+        # 只合并这一项，保留其他配置
+        core_config.update({'recent_memory_auto_review': enabled})
         
         logger.info(f"记忆审阅配置已更新: enabled={enabled}")
         return {"success": True, "enabled": enabled}
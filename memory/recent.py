@@ -4,11 +4,69 @@ from langchain_openai import ChatOpenAI
 from langchain_core.messages import SystemMessage, messages_to_dict, messages_from_dict, HumanMessage, AIMessage
 import json
 import os
+import re
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait
 
 from config.api import CORRECTION_MODEL
+from config.core_config import core_config
 from config.prompts_sys import recent_history_manager_prompt, detailed_recent_history_manager_prompt, further_summarize_prompt, history_review_prompt
+try:
+    import tiktoken
+except Exception:
+    tiktoken = None
+
+_CJK_PATTERN = re.compile(r'[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uff00-\uffef]')
+
+
+def _estimate_tokens(text):
+    """无 tiktoken 时的快速估算：CJK 字符按 1 token 计，其余按约 4 字符 1 token 计。"""
+    cjk = len(_CJK_PATTERN.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+def _default_tokenizer():
+    if tiktoken is not None:
+        try:
+            encoding = tiktoken.get_encoding("cl100k_base")
+            return lambda text: len(encoding.encode(text, disallowed_special=()))
+        except Exception:
+            pass
+    return _estimate_tokens
+
+
+def _message_text(msg):
+    content = getattr(msg, 'content', '')
+    if isinstance(content, str):
+        return content
+    parts = []
+    try:
+        for item in content:
+            if isinstance(item, dict):
+                parts.append(item.get('text', ''))
+            else:
+                parts.append(str(item))
+    except Exception:
+        return str(content)
+    return "\n".join(parts)
+
 
 class CompressedRecentHistoryManager:
+    # 事件级摘要缓存的容量：同一条 /process 记录会被多个记忆存储各摘要一次，缓存后共享结果
+    summary_cache_size = 256
+    # 内存中的历史是权威数据：每次更新只向 journal 追加增量，
+    # 快照文件按延迟（秒）或 journal 条数阈值做一次原子的检查点/压缩
+    flush_delay_sec = 10.0
+    journal_checkpoint_every = 64
+    # /new_dialog 与 /get_recent_history 使用的 token 预算（<=0 表示只按消息条数截断）
+    token_budget = 4096
+    token_count_cache_size = 4096
+    # 溢出摘要的步长：历史超出 max_history_length 这么多条（且不超过窗口的一半）才触发一次摘要
+    summary_chunk = 16
+
     def __init__(self, max_history_length=64):
         # 通过get_character_data获取相关变量
         _, _, _, _, name_mapping, _, _, _, _, recent_log = get_character_data()
@@ -20,20 +78,9 @@ class CompressedRecentHistoryManager:
         for k, v in recent_log.items():
             recent_log_abs[k] = os.path.join(base_store_dir, os.path.basename(v))
         api_key = OPENROUTER_API_KEY if OPENROUTER_API_KEY and OPENROUTER_API_KEY != '' else None
-        disable_remote = False
-        cfg_window = None
-        try:
-            cfg_path = os.path.join(os.path.dirname(__file__), '..', 'config', 'core_config.json')
-            if os.path.exists(cfg_path):
-                with open(cfg_path, 'r', encoding='utf-8') as f:
-                    cfg = json.load(f)
-                disable_remote = bool(cfg.get('recent_memory_disable_remote_summary', False))
-                try:
-                    cfg_window = int(cfg.get('recent_cache_window', None))
-                except Exception:
-                    cfg_window = None
-        except Exception:
-            disable_remote = False
+        disable_remote = core_config.get_bool('recent_memory_disable_remote_summary', False)
+        cfg_window = core_config.get_int('recent_cache_window', None)
+        cfg_budget = core_config.get_int('recent_token_budget', None)
 
         self.llm = None
         self.review_llm = None
@@ -46,52 +93,264 @@ class CompressedRecentHistoryManager:
             self.llm = None
             self.review_llm = None
         self.max_history_length = (cfg_window if isinstance(cfg_window, int) and cfg_window > 0 else max_history_length if max_history_length > 0 else 128)
+        if cfg_budget is not None:
+            self.token_budget = cfg_budget
+        self._tokenizer = _default_tokenizer()
+        # 每条消息的 token 数缓存：sha1(文本) -> token 数
+        self._token_counts = OrderedDict()
+        self._token_counts_lock = threading.Lock()
         self.log_file_path = recent_log_abs
         self.name_mapping = name_mapping
         self.user_histories = {}
-        self.session_summaries = {}
-        self.last_summary_index = {}
+        # 溢出摘要在后台线程中生成，生成期间原始消息照常保留在历史中
+        self._summary_jobs = {}
+        self._summary_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="recent-summary")
+        # 文件版本 (mtime_ns, size)：用于发现外部修改（如记忆浏览器的保存接口）
+        self._file_version = {}
+        # 快照文件内容的 sha1：journal 首行记录其基于的快照，不匹配的 journal 视为过期
+        self._snapshot_hash = {}
+        self._journal_len = {}
+        self._flush_timers = {}
+        # 每个角色一把锁：不同角色的更新可以并行，同一角色的读写互斥
+        self._locks = {}
+        self._locks_guard = threading.Lock()
         for ln in self.log_file_path:
             # 确保父目录存在
             dirname = os.path.dirname(self.log_file_path[ln])
             os.makedirs(dirname, exist_ok=True)
-            if os.path.exists(self.log_file_path[ln]):
-                with open(self.log_file_path[ln], encoding='utf-8') as f:
-                    self.user_histories[ln] = messages_from_dict(json.load(f))
-            else:
-                self.user_histories[ln] = []
-            self.session_summaries[ln] = []
-            self.last_summary_index[ln] = 0
+            self.user_histories[ln] = []
+            self._load_from_file(ln)
+        self._summary_cache = OrderedDict()
+        self._summary_cache_lock = threading.Lock()
 
 
-    def update_history(self, new_messages, lanlan_name, detailed=False):
-        if os.path.exists(self.log_file_path[lanlan_name]):
-            with open(self.log_file_path[lanlan_name], encoding='utf-8') as f:
-                self.user_histories[lanlan_name] = messages_from_dict(json.load(f))
+    def _lock(self, lanlan_name):
+        with self._locks_guard:
+            lock = self._locks.get(lanlan_name)
+            if lock is None:
+                lock = self._locks[lanlan_name] = threading.RLock()
+            return lock
+
+    def _stat_version(self, lanlan_name):
+        try:
+            st = os.stat(self.log_file_path[lanlan_name])
+            return (st.st_mtime_ns, st.st_size)
+        except OSError:
+            return None
+
+    def _journal_path(self, lanlan_name):
+        base, _ = os.path.splitext(self.log_file_path[lanlan_name])
+        return f"{base}.journal.jsonl"
+
+    def _load_from_file(self, lanlan_name):
+        path = self.log_file_path[lanlan_name]
+        version = self._stat_version(lanlan_name)
+        raw = b""
+        if version is not None:
+            try:
+                with open(path, 'rb') as f:
+                    raw = f.read()
+                self.user_histories[lanlan_name] = messages_from_dict(json.loads(raw.decode('utf-8')))
+            except Exception as e:
+                print(f"读取近期记忆文件失败 {path}: {e}")
+        self._file_version[lanlan_name] = version
+        self._snapshot_hash[lanlan_name] = hashlib.sha1(raw).hexdigest()
+        self._journal_len[lanlan_name] = 0
+        if self._replay_journal(lanlan_name):
+            # 启动时把 journal 压缩回快照，之后从空 journal 开始追加
+            try:
+                self._write_file(lanlan_name)
+            except Exception as e:
+                print(f"近期记忆检查点失败 {path}: {e}")
+
+    def _replay_journal(self, lanlan_name):
+        """
+        在快照之上重放 journal，返回是否应用了任何记录。
+        进程中途退出时最后一行可能不完整，遇到无法解析的行即停止；
+        首行的 base 与当前快照不一致（已做过检查点或快照被外部改写）时整份 journal 作废。
+        """
+        jpath = self._journal_path(lanlan_name)
+        if not os.path.exists(jpath):
+            return False
+        applied = 0
+        try:
+            with open(jpath, encoding='utf-8') as f:
+                header = json.loads(f.readline() or '{}')
+                if header.get('base') != self._snapshot_hash[lanlan_name]:
+                    print(f"💡 {lanlan_name} 的近期记忆 journal 已过期，丢弃")
+                else:
+                    for line in f:
+                        try:
+                            rec = json.loads(line)
+                            msgs = messages_from_dict(rec.get('messages', []))
+                        except Exception:
+                            print(f"⚠️ {lanlan_name} 的近期记忆 journal 末尾不完整，已截断")
+                            break
+                        if rec.get('op') == 'replace':
+                            self.user_histories[lanlan_name] = msgs
+                        else:
+                            self.user_histories[lanlan_name].extend(msgs)
+                        applied += 1
+        except Exception as e:
+            print(f"重放近期记忆 journal 失败 {jpath}: {e}")
+        if not applied:
+            try:
+                os.remove(jpath)
+            except OSError:
+                pass
+        return applied > 0
+
+    def _append_journal(self, lanlan_name, op, messages):
+        """追加一条 journal 记录（append：新增消息；replace：整体替换），写入量只与增量相关。"""
+        jpath = self._journal_path(lanlan_name)
+        record = json.dumps({"op": op, "messages": messages_to_dict(messages)}, ensure_ascii=False, separators=(',', ':'))
+        try:
+            with open(jpath, 'a', encoding='utf-8') as f:
+                if self._journal_len.get(lanlan_name, 0) == 0:
+                    f.truncate(0)
+                    f.write(json.dumps({"base": self._snapshot_hash.get(lanlan_name)}) + "\n")
+                f.write(record + "\n")
+            self._journal_len[lanlan_name] = self._journal_len.get(lanlan_name, 0) + 1
+        except Exception as e:
+            print(f"写入近期记忆 journal 失败 {jpath}: {e}")
+            self._schedule_flush(lanlan_name)
+            return
+        if self._journal_len[lanlan_name] >= self.journal_checkpoint_every:
+            self._schedule_flush(lanlan_name)
+            self.flush(lanlan_name)
+        else:
+            self._schedule_flush(lanlan_name)
 
+    def _reload_if_changed(self, lanlan_name):
+        """快照被外部改写时（版本与上次读写不一致）重新加载；否则直接使用内存数据。"""
+        version = self._stat_version(lanlan_name)
+        if version is not None and version != self._file_version.get(lanlan_name):
+            timer = self._flush_timers.pop(lanlan_name, None)
+            if timer is not None:
+                timer.cancel()
+            self._load_from_file(lanlan_name)
+
+    def _write_file(self, lanlan_name):
+        """检查点：原子替换快照文件，然后清空 journal。"""
+        path = self.log_file_path[lanlan_name]
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        raw = json.dumps(messages_to_dict(self.user_histories[lanlan_name]), ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(raw)
+        os.replace(tmp_path, path)
+        self._file_version[lanlan_name] = self._stat_version(lanlan_name)
+        self._snapshot_hash[lanlan_name] = hashlib.sha1(raw).hexdigest()
+        # 快照已包含全部数据；即使此处删除失败，残留 journal 的 base 也与新快照不匹配而会被忽略
         try:
+            os.remove(self._journal_path(lanlan_name))
+        except OSError:
+            pass
+        self._journal_len[lanlan_name] = 0
+
+    def _schedule_flush(self, lanlan_name):
+        if lanlan_name in self._flush_timers:
+            return
+        timer = threading.Timer(self.flush_delay_sec, self.flush, args=(lanlan_name,))
+        timer.daemon = True
+        self._flush_timers[lanlan_name] = timer
+        timer.start()
+
+    def flush(self, lanlan_name=None):
+        """立即做检查点：把内存中的历史写成快照并清空 journal；lanlan_name 为空时处理全部角色。"""
+        names = [lanlan_name] if lanlan_name is not None else list(self._flush_timers)
+        for name in names:
+            with self._lock(name):
+                timer = self._flush_timers.pop(name, None)
+                if timer is None:
+                    continue
+                timer.cancel()
+                try:
+                    self._write_file(name)
+                except Exception as e:
+                    print(f"写入近期记忆文件失败 {self.log_file_path[name]}: {e}")
+
+    def update_history(self, new_messages, lanlan_name, detailed=False):
+        with self._lock(lanlan_name):
+            self._reload_if_changed(lanlan_name)
             self.user_histories[lanlan_name].extend(new_messages)
+            self._append_journal(lanlan_name, 'append', new_messages)
+            self._maybe_schedule_summary(lanlan_name, detailed)
 
-            if len(self.user_histories[lanlan_name]) > self.max_history_length:
-                tail_start = len(self.user_histories[lanlan_name]) - self.max_history_length + 1
-                overflow_start = self.last_summary_index.get(lanlan_name, 0)
-                if overflow_start < tail_start:
-                    to_compress = self.user_histories[lanlan_name][overflow_start:tail_start]
-                    summary_msg, _ = self.compress_history(to_compress, lanlan_name, detailed)
-                    self.session_summaries[lanlan_name].append(summary_msg)
-                    self.last_summary_index[lanlan_name] = tail_start
-                recent_tail = self.user_histories[lanlan_name][-self.max_history_length+1:]
-                self.user_histories[lanlan_name] = self.session_summaries[lanlan_name] + recent_tail
+    @staticmethod
+    def _summary_prefix_len(history):
+        """历史开头连续的备忘录消息数量（此前溢出摘要的结果）。"""
+        n = 0
+        for msg in history:
+            if getattr(msg, 'type', '') == 'system' and isinstance(msg.content, str) and msg.content.startswith("先前对话的备忘录"):
+                n += 1
+            else:
+                break
+        return n
+
+    def _maybe_schedule_summary(self, lanlan_name, detailed=False):
+        """
+        历史超过 max_history_length + 摘要步长时，把开头的旧备忘录连同溢出部分一起交给后台摘要；调用方需持有该角色的锁。
+        旧备忘录并入新摘要，因此历史开头始终最多只有一条备忘录；
+        步长让摘要按批触发，而不是每次更新都调用一次摘要模型。
+        溢出的原始消息先原样保留，摘要完成后由 _apply_summary 原子替换。
+        """
+        job = self._summary_jobs.get(lanlan_name)
+        if job is not None and not job.done():
+            return
+        history = self.user_histories[lanlan_name]
+        chunk = max(1, min(self.summary_chunk, self.max_history_length // 2))
+        if len(history) <= self.max_history_length + chunk:
+            return
+        overflow_end = len(history) - self.max_history_length + 1
+        to_compress = history[:overflow_end]
+        self._summary_jobs[lanlan_name] = self._summary_executor.submit(
+            self._run_summary, lanlan_name, to_compress, detailed
+        )
+
+    def _run_summary(self, lanlan_name, to_compress, detailed):
+        try:
+            summary_msg, summary_text = self.compress_history(to_compress, lanlan_name, detailed)
         except Exception as e:
-            print("Error when updating history: ", e)
-            import traceback
-            traceback.print_exc()
+            print("Error when summarizing history overflow: ", e)
+            return
+        if not summary_text and self._summary_prefix_len(to_compress):
+            # 摘要失败时不能用“无”覆盖已有备忘录，保留原样等下次再试
+            print(f"💥 {lanlan_name} 的溢出摘要失败，保留原有备忘录")
+            return
+        self._apply_summary(lanlan_name, to_compress, summary_msg, detailed)
+
+    def _apply_summary(self, lanlan_name, to_compress, summary_msg, detailed):
+        with self._lock(lanlan_name):
+            history = self.user_histories[lanlan_name]
+            end = len(to_compress)
+            # 摘要期间历史可能被外部编辑、审阅或清空：只有被摘要的那段消息仍原样在位时才替换
+            if len(history) < end or any(a is not b for a, b in zip(history[:end], to_compress)):
+                print(f"💡 {lanlan_name} 的近期记忆在摘要期间已变更，丢弃本次摘要")
+                return
+            self.user_histories[lanlan_name] = [summary_msg] + history[end:]
+            self._append_journal(lanlan_name, 'replace', self.user_histories[lanlan_name])
+            # 摘要期间又累积了新消息时继续处理
+            self._summary_jobs.pop(lanlan_name, None)
+            self._maybe_schedule_summary(lanlan_name, detailed)
 
-        # 写入前确保目录存在
-        os.makedirs(os.path.dirname(self.log_file_path[lanlan_name]), exist_ok=True)
-        with open(self.log_file_path[lanlan_name], "w", encoding='utf-8') as f:
-            json.dump(messages_to_dict(self.user_histories[lanlan_name]), f, indent=2, ensure_ascii=False)
+    def wait_for_summaries(self, timeout=None):
+        """等待当前所有后台溢出摘要完成（用于关闭前或离线脚本）；timeout 为总等待秒数。返回是否全部完成。"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            pending = [job for job in list(self._summary_jobs.values()) if not job.done()]
+            if not pending:
+                return True
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if remaining is not None and remaining <= 0:
+                return False
+            wait(pending, timeout=remaining)
 
+    def close(self, timeout=None):
+        """关闭前调用：等待后台摘要写回、停止摘要线程池，再把所有角色的历史落盘。"""
+        self.wait_for_summaries(timeout=timeout)
+        self._summary_executor.shutdown(wait=False)
+        self.flush()
 
     # detailed: 保留尽可能多的细节
     def compress_history(self, messages, lanlan_name, detailed=False):
@@ -157,6 +416,30 @@ class CompressedRecentHistoryManager:
         # 如果所有重试都失败，返回简要备忘录
         return SystemMessage(content=f"先前对话的备忘录: 无。"), ""
 
+    def summarize_event(self, event_id, messages, lanlan_name, detailed=False):
+        """
+        带缓存的 compress_history：以 (event_id, 消息内容哈希) 为键，
+        语义记忆与时间索引记忆对同一事件只触发一次摘要模型调用。
+        """
+        try:
+            digest = hashlib.sha1(
+                json.dumps(messages_to_dict(messages), ensure_ascii=False, sort_keys=True).encode('utf-8')
+            ).hexdigest()
+        except Exception:
+            return self.compress_history(messages, lanlan_name, detailed)
+        key = (event_id, lanlan_name, detailed, digest)
+        with self._summary_cache_lock:
+            cached = self._summary_cache.get(key)
+            if cached is not None:
+                self._summary_cache.move_to_end(key)
+                return cached
+        result = self.compress_history(messages, lanlan_name, detailed)
+        with self._summary_cache_lock:
+            self._summary_cache[key] = result
+            while len(self._summary_cache) > self.summary_cache_size:
+                self._summary_cache.popitem(last=False)
+        return result
+
     def further_compress(self, initial_summary):
         retries = 0
         while retries < 3:
@@ -182,27 +465,69 @@ class CompressedRecentHistoryManager:
         return None
 
     def get_recent_history(self, lanlan_name):
-        if os.path.exists(self.log_file_path[lanlan_name]):
-            with open(self.log_file_path[lanlan_name], encoding='utf-8') as f:
-                self.user_histories[lanlan_name] = messages_from_dict(json.load(f))
-        return self.user_histories[lanlan_name]
+        with self._lock(lanlan_name):
+            self._reload_if_changed(lanlan_name)
+            return list(self.user_histories[lanlan_name])
+
+    def set_tokenizer(self, tokenizer):
+        """替换 token 计数函数（text -> int），用于与实际模型的分词器对齐。"""
+        self._tokenizer = tokenizer
+        with self._token_counts_lock:
+            self._token_counts.clear()
+
+    def count_tokens(self, msg):
+        text = _message_text(msg)
+        key = hashlib.sha1(text.encode('utf-8')).hexdigest()
+        with self._token_counts_lock:
+            n = self._token_counts.get(key)
+            if n is not None:
+                self._token_counts.move_to_end(key)
+                return n
+        n = self._tokenizer(text)
+        with self._token_counts_lock:
+            self._token_counts[key] = n
+            while len(self._token_counts) > self.token_count_cache_size:
+                self._token_counts.popitem(last=False)
+        return n
+
+    def get_recent_window(self, lanlan_name, token_budget=None):
+        """
+        按 token 预算截取近期历史：最后一条消息总是保留；开头的备忘录（长期上下文的压缩摘要）优先占用剩余预算，
+        放不下时从最旧的备忘录开始丢弃；其余预算从最新消息往前累加，超出即停止。
+        token_budget 为空时使用 self.token_budget；预算 <=0 时等同于 get_recent_history。
+        """
+        history = self.get_recent_history(lanlan_name)
+        budget = self.token_budget if token_budget is None else token_budget
+        if budget is None or budget <= 0 or not history:
+            return history
+        prefix_len = self._summary_prefix_len(history)
+        if prefix_len == len(history):
+            prefix_len -= 1
+        total = self.count_tokens(history[-1])
+        memo_start = prefix_len
+        for i in range(prefix_len - 1, -1, -1):
+            n = self.count_tokens(history[i])
+            if total + n > budget:
+                break
+            total += n
+            memo_start = i
+        start = len(history) - 1
+        for i in range(len(history) - 2, prefix_len - 1, -1):
+            total += self.count_tokens(history[i])
+            if total > budget:
+                break
+            start = i
+        return history[memo_start:prefix_len] + history[start:]
 
     def review_history(self, lanlan_name):
         """
         审阅历史记录，寻找并修正矛盾、冗余、逻辑混乱或复读的部分
         """
         # 检查配置文件中是否禁用自动审阅
-        try:
-            config_path = os.path.join(os.path.dirname(__file__), '..', 'config', 'core_config.json')
-            if os.path.exists(config_path):
-                with open(config_path, 'r', encoding='utf-8') as f:
-                    config_data = json.load(f)
-                    if 'recent_memory_auto_review' in config_data and not config_data['recent_memory_auto_review']:
-                        print(f"💡 {lanlan_name} 的自动记忆审阅已禁用，跳过审阅")
-                        return False
-        except Exception as e:
-            print(f"⚠️ 读取配置文件失败：{e}，继续执行审阅")
-        
+        if not core_config.get_bool('recent_memory_auto_review', True):
+            print(f"💡 {lanlan_name} 的自动记忆审阅已禁用，跳过审阅")
+            return False
+
         # 获取当前历史记录
         
         current_history = self.get_recent_history(lanlan_name)
@@ -273,12 +598,11 @@ class CompressedRecentHistoryManager:
                         # 默认作为用户消息处理
                         corrected_messages.append(HumanMessage(content=content))
                 
-                # 更新历史记录
-                self.user_histories[lanlan_name] = corrected_messages
-                
-                # 保存到文件
-                with open(self.log_file_path[lanlan_name], "w", encoding='utf-8') as f:
-                    json.dump(messages_to_dict(corrected_messages), f, indent=2, ensure_ascii=False)
+                # 更新历史记录并立即落盘
+                with self._lock(lanlan_name):
+                    self.user_histories[lanlan_name] = corrected_messages
+                    self._schedule_flush(lanlan_name)
+                    self.flush(lanlan_name)
                 
                 print(f"✅ {lanlan_name} 的记忆已修正并保存")
                 return True
@@ -296,4 +620,6 @@ class CompressedRecentHistoryManager:
         """
         清除用户的聊天历史
         """
-        self.user_histories[lanlan_name] = []
+        with self._lock(lanlan_name):
+            self.user_histories[lanlan_name] = []
+            self._append_journal(lanlan_name, 'replace', [])
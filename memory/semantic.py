@@ -1,6 +1,6 @@
 from typing import List
 from langchain_core.documents import Document
-from datetime import datetime
+from datetime import datetime, date, timedelta
 from memory.recent import CompressedRecentHistoryManager
 import os
 from config import get_character_data, SEMANTIC_MODEL, OPENROUTER_API_KEY, OPENROUTER_URL, RERANKER_MODEL
@@ -11,8 +11,450 @@ try:
 except Exception:
     chromadb = None
     embedding_functions = None
+try:
+    from sentence_transformers import CrossEncoder, SentenceTransformer
+except Exception:
+    CrossEncoder = None
+    SentenceTransformer = None
+try:
+    import hnswlib
+except Exception:
+    hnswlib = None
+import numpy as np
 from config.prompts_sys import semantic_manager_prompt
+from config.core_config import core_config
 import json
+import time
+import queue
+import sqlite3
+import shutil
+import zlib
+import hashlib
+import threading
+from array import array
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+
+EMBEDDING_MODEL_NAME = "all-MiniLM-L6-v2"
+# 既没有 Chroma 也没有 sentence-transformers 时使用的特征哈希嵌入维度
+HASHING_EMBEDDING_DIM = 512
+# 本地重排默认使用多语言的小型 cross-encoder（CPU 上对几十个候选只需几十毫秒）
+CROSS_ENCODER_MODEL_NAME = "cross-encoder/mmarco-mMiniLMv2-L12-H384-v1"
+
+
+class _EmbeddingBatcher:
+    """
+    嵌入微批处理：把并发调用方的文本在几毫秒内攒成一批，做一次批量前向计算后再按调用方拆分结果。
+    CPU 上 16~64 的批量比逐条调用吞吐高得多。
+    """
+    def __init__(self, embed_fn, max_batch=64, max_wait_sec=0.005):
+        self._embed_fn = embed_fn
+        self.max_batch = max_batch
+        self.max_wait_sec = max_wait_sec
+        self._queue = queue.Queue()
+        self._thread = None
+        self._thread_lock = threading.Lock()
+
+    def _ensure_thread(self):
+        with self._thread_lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="embedding-batcher", daemon=True)
+                self._thread.start()
+
+    def embed(self, texts):
+        texts = list(texts)
+        if not texts:
+            return []
+        future = Future()
+        self._ensure_thread()
+        self._queue.put((texts, future))
+        return future.result()
+
+    def _run(self):
+        while True:
+            items = [self._queue.get()]
+            # 任何异常都要落到本批次每个 future 上，否则调用方会在 future.result() 上永远阻塞
+            try:
+                self._collect(items)
+                self._embed_batch(items)
+            except Exception as e:
+                for _, future in items:
+                    if not future.done():
+                        future.set_exception(e)
+
+    def _collect(self, items):
+        """在 max_wait_sec 内继续攒批，直到文本数达到 max_batch。"""
+        count = len(items[0][0])
+        deadline = time.monotonic() + self.max_wait_sec
+        while count < self.max_batch:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                item = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            items.append(item)
+            count += len(item[0])
+
+    def _embed_batch(self, items):
+        # 同一批次里的重复文本（如并发查询同一句话）只计算一次
+        unique = list(dict.fromkeys(t for batch, _ in items for t in batch))
+        embedded = list(self._embed_fn(unique))
+        if len(embedded) != len(unique):
+            raise ValueError(f"嵌入函数返回了 {len(embedded)} 个向量，应为 {len(unique)} 个")
+        vectors = dict(zip(unique, embedded))
+        for batch, future in items:
+            future.set_result([vectors[t] for t in batch])
+
+
+class _EmbeddingCache:
+    """
+    按内容寻址的持久化嵌入缓存（SQLite）：键为 sha1(模型名 + 规范化文本)，向量以 float32 存储。
+    前面再加一层进程内 LRU，重复查询几乎零开销；超出容量时按最近使用时间淘汰。
+    """
+    def __init__(self, db_path, max_entries=200_000, memory_entries=4096):
+        self.max_entries = max_entries
+        self.memory_entries = memory_entries
+        self._lock = threading.Lock()
+        self._memory = OrderedDict()
+        self._writes_since_evict = 0
+        os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, vector BLOB NOT NULL, last_used REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_embeddings_last_used ON embeddings(last_used)")
+        self._conn.commit()
+
+    @staticmethod
+    def make_key(model_name, text):
+        normalized = " ".join((text or "").split())
+        return hashlib.sha1(f"{model_name}\x00{normalized}".encode('utf-8')).hexdigest()
+
+    def get_many(self, keys):
+        """返回 {key: vector}，只包含命中的键。"""
+        found = {}
+        missing = []
+        with self._lock:
+            for key in keys:
+                vec = self._memory.get(key)
+                if vec is not None:
+                    self._memory.move_to_end(key)
+                    found[key] = vec
+                else:
+                    missing.append(key)
+            if missing:
+                unique = list(dict.fromkeys(missing))
+                for i in range(0, len(unique), 500):
+                    chunk = unique[i:i + 500]
+                    rows = self._conn.execute(
+                        f"SELECT key, vector FROM embeddings WHERE key IN ({','.join('?' * len(chunk))})", chunk
+                    ).fetchall()
+                    for key, blob in rows:
+                        vec = array('f')
+                        vec.frombytes(blob)
+                        found[key] = vec.tolist()
+                        self._remember(key, found[key])
+                    if rows:
+                        now = time.time()
+                        self._conn.executemany(
+                            "UPDATE embeddings SET last_used = ? WHERE key = ?", [(now, key) for key, _ in rows]
+                        )
+                self._conn.commit()
+        return found
+
+    def put_many(self, items):
+        if not items:
+            return
+        now = time.time()
+        with self._lock:
+            for key, vec in items:
+                self._remember(key, list(vec))
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (key, vector, last_used) VALUES (?, ?, ?)",
+                [(key, array('f', vec).tobytes(), now) for key, vec in items]
+            )
+            self._writes_since_evict += len(items)
+            if self._writes_since_evict >= 1000:
+                self._writes_since_evict = 0
+                self._conn.execute(
+                    "DELETE FROM embeddings WHERE key IN (SELECT key FROM embeddings ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+                    (self.max_entries,)
+                )
+            self._conn.commit()
+
+    def _remember(self, key, vec):
+        self._memory[key] = vec
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_entries:
+            self._memory.popitem(last=False)
+
+
+def _hashing_embed(texts, dim=HASHING_EMBEDDING_DIM):
+    """
+    离线兜底嵌入：字符一元/二元组做带符号的特征哈希并 L2 归一化。
+    不依赖任何模型，对中日文逐字切分也有效，足以支撑词面相近的召回。
+    """
+    out = np.zeros((len(texts), dim), dtype=np.float32)
+    for row, text in enumerate(texts):
+        chars = " ".join((text or "").lower().split())
+        grams = list(chars) + [chars[i:i + 2] for i in range(len(chars) - 1)]
+        for g in grams:
+            h = zlib.crc32(g.encode('utf-8'))
+            out[row, h % dim] += 1.0 if (h >> 31) & 1 else -1.0
+    norms = np.linalg.norm(out, axis=1)
+    norms[norms == 0] = 1.0
+    return (out / norms[:, None]).tolist()
+
+
+class _BatchedEmbeddingFunction:
+    """
+    Chroma 嵌入函数包装：先查嵌入缓存，未命中的文本走共享的微批处理器；
+    其余属性（name/get_config 等）转发给原始实现。
+    """
+    def __init__(self, inner, model_name=EMBEDDING_MODEL_NAME, cache=None):
+        self._inner = inner
+        self._model_name = model_name
+        self._cache = cache
+        self._batcher = _EmbeddingBatcher(inner)
+
+    def __call__(self, input):
+        texts = list(input)
+        if self._cache is None:
+            return self._batcher.embed(texts)
+        keys = [_EmbeddingCache.make_key(self._model_name, t) for t in texts]
+        try:
+            found = self._cache.get_many(keys)
+        except Exception as e:
+            print("读取嵌入缓存失败：", e)
+            found = {}
+        todo = {}
+        for key, text in zip(keys, texts):
+            if key not in found and key not in todo:
+                todo[key] = text
+        if todo:
+            vectors = self._batcher.embed(list(todo.values()))
+            computed = list(zip(todo.keys(), [list(v) for v in vectors]))
+            found.update(computed)
+            try:
+                self._cache.put_many(computed)
+            except Exception as e:
+                print("写入嵌入缓存失败：", e)
+        return [found[key] for key in keys]
+
+    def __getattr__(self, item):
+        return getattr(self._inner, item)
+
+
+class _EmbeddingService:
+    """
+    进程内共享的嵌入服务：同一模型只加载一次，同一持久化目录只创建一个 Chroma 客户端，
+    供所有角色的原始/压缩语义记忆共用。
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._embedding_functions = {}
+        self._clients = {}
+        self._cross_encoders = {}
+        self._cache = None
+
+    def _embedding_cache(self):
+        if self._cache is None:
+            try:
+                db_path = os.path.join(os.path.dirname(__file__), 'store', 'embedding_cache.sqlite3')
+                self._cache = _EmbeddingCache(db_path)
+            except Exception as e:
+                print("初始化嵌入缓存失败：", e)
+        return self._cache
+
+    def embedding_function(self, model_name=EMBEDDING_MODEL_NAME):
+        with self._lock:
+            ef = self._embedding_functions.get(model_name)
+            if ef is None:
+                ef = _BatchedEmbeddingFunction(
+                    embedding_functions.SentenceTransformerEmbeddingFunction(model_name=model_name),
+                    model_name=model_name,
+                    cache=self._embedding_cache(),
+                )
+                self._embedding_functions[model_name] = ef
+            return ef
+
+    def client(self, persist_path):
+        key = os.path.abspath(persist_path)
+        with self._lock:
+            client = self._clients.get(key)
+            if client is None:
+                client = chromadb.PersistentClient(path=key)
+                self._clients[key] = client
+            return client
+
+    def local_embedding_function(self, model_name=EMBEDDING_MODEL_NAME):
+        """没有 Chroma 时供内存向量库使用的嵌入函数：优先 sentence-transformers，否则特征哈希。"""
+        key = f"local:{model_name}"
+        with self._lock:
+            ef = self._embedding_functions.get(key)
+            if ef is not None:
+                return ef
+        if SentenceTransformer is not None:
+            try:
+                model = SentenceTransformer(model_name, device="cpu")
+                inner = lambda texts: model.encode(list(texts), batch_size=64, normalize_embeddings=True).tolist()
+                cache_name = model_name
+            except Exception as e:
+                print("加载本地嵌入模型失败，改用特征哈希嵌入：", e)
+                inner, cache_name = _hashing_embed, f"hashing-{HASHING_EMBEDDING_DIM}"
+        else:
+            inner, cache_name = _hashing_embed, f"hashing-{HASHING_EMBEDDING_DIM}"
+        ef = _BatchedEmbeddingFunction(inner, model_name=cache_name, cache=self._embedding_cache())
+        with self._lock:
+            return self._embedding_functions.setdefault(key, ef)
+
+    def cross_encoder(self, model_name=CROSS_ENCODER_MODEL_NAME):
+        with self._lock:
+            model = self._cross_encoders.get(model_name)
+            if model is None:
+                model = CrossEncoder(model_name, device="cpu")
+                self._cross_encoders[model_name] = model
+            return model
+
+
+embedding_service = _EmbeddingService()
+
+# hybrid_search 并行查询原始/压缩两个向量库所用的线程池
+_search_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="semantic-search")
+RRF_K = 60
+
+
+def _to_date(value):
+    if value is None or isinstance(value, date) and not isinstance(value, datetime):
+        return value
+    if isinstance(value, datetime):
+        return value.date()
+    return datetime.fromisoformat(str(value)).date()
+
+
+def _in_clause(key, values):
+    return {key: values[0]} if len(values) == 1 else {key: {"$in": values}}
+
+
+def _month_end(d):
+    return date(d.year + (d.month == 12), d.month % 12 + 1, 1) - timedelta(days=1)
+
+
+def _year_clauses(lo, hi):
+    """同一年内 [lo, hi] 的子句：整年只比较 year，整月合并为一个 month $in，首尾不完整的月份再用 day。"""
+    year = str(lo.year)
+    if lo == date(lo.year, 1, 1) and hi == date(lo.year, 12, 31):
+        return [{"year": year}]
+    clauses = []
+    full_months = []
+    for m in range(lo.month, hi.month + 1):
+        first = date(lo.year, m, 1)
+        last = _month_end(first)
+        m_lo, m_hi = max(first, lo), min(last, hi)
+        if m_lo == first and m_hi == last:
+            full_months.append("%02d" % m)
+        else:
+            days = ["%02d" % d for d in range(m_lo.day, m_hi.day + 1)]
+            clauses.append({"$and": [{"year": year}, {"month": "%02d" % m}, _in_clause("day", days)]})
+    if full_months:
+        clauses.insert(0, {"$and": [{"year": year}, _in_clause("month", full_months)]})
+    return clauses
+
+
+def build_date_where(start_date=None, end_date=None):
+    """
+    把日期范围转换成 Chroma where 子句，作用于写入时已有的 year/month/day 字符串元数据。
+    Chroma 的 $gte/$lte 只支持数值，因此完整覆盖的年份合并为一个 year $in，只在首尾两年按月/按日展开，
+    子句数量与范围跨度无关。未给 start_date 时不设下界：用 year $nin 排除 end_date 之后的年份。
+    """
+    start, end = _to_date(start_date), _to_date(end_date)
+    if start is None and end is None:
+        return None
+    if end is None:
+        end = date.today()
+    if start is not None and start > end:
+        start, end = end, start
+    clauses = []
+    if start is None:
+        # end 所在年之前的年份全部命中；之后的年份（到今年为止）排除
+        later = [str(y) for y in range(end.year, max(end.year, date.today().year) + 1)]
+        clauses.append({"year": {"$nin": later}})
+        clauses.extend(_year_clauses(date(end.year, 1, 1), end))
+    elif start.year == end.year:
+        clauses.extend(_year_clauses(start, end))
+    else:
+        clauses.extend(_year_clauses(start, date(start.year, 12, 31)))
+        full_years = [str(y) for y in range(start.year + 1, end.year)]
+        if full_years:
+            clauses.append(_in_clause("year", full_years))
+        clauses.extend(_year_clauses(date(end.year, 1, 1), end))
+    return clauses[0] if len(clauses) == 1 else {"$or": clauses}
+
+
+def _match_where(meta, where):
+    """在内存后端上求值 Chroma 风格的 where 子句（支持 $and/$or/$in/$nin/$eq/$ne 和直接相等）。"""
+    if not where:
+        return True
+    for key, cond in where.items():
+        if key == "$and":
+            if not all(_match_where(meta, c) for c in cond):
+                return False
+        elif key == "$or":
+            if not any(_match_where(meta, c) for c in cond):
+                return False
+        elif isinstance(cond, dict):
+            value = meta.get(key)
+            for op, arg in cond.items():
+                if op == "$in" and value not in arg:
+                    return False
+                if op == "$nin" and value in arg:
+                    return False
+                if op == "$eq" and value != arg:
+                    return False
+                if op == "$ne" and value == arg:
+                    return False
+        elif meta.get(key) != cond:
+            return False
+    return True
+
+
+def _time_metadata(ts):
+    """由同一个时间点生成 year/month/day/... 元数据（供 where 过滤使用）。"""
+    return {
+        "year": str(ts.year),
+        "month": "%02d" % ts.month,
+        "day": "%02d" % ts.day,
+        "weekday": "%02d" % ts.weekday(),
+        "hour": "%02d" % ts.hour,
+        "minute": "%02d" % ts.minute,
+        "timestamp": ts.isoformat()
+    }
+
+
+def reciprocal_rank_fusion(result_lists, k=RRF_K):
+    """
+    倒数排名融合：每个结果列表按距离升序排名，同一 event_id 在单个列表中只取最好名次，
+    各列表得分 1/(k+rank) 相加；代表文档取距离最小的那条。返回按融合分数降序的文档列表。
+    """
+    scores = {}
+    best = {}
+    for results in result_lists:
+        seen = set()
+        ranked = sorted(results, key=lambda pair: pair[1] if pair[1] is not None else float('inf'))
+        for rank, (doc, distance) in enumerate(ranked):
+            key = (doc.metadata or {}).get("event_id") or doc.page_content
+            if key in seen:
+                continue
+            seen.add(key)
+            scores[key] = scores.get(key, 0.0) + 1.0 / (k + rank + 1)
+            dist = distance if distance is not None else float('inf')
+            if key not in best or dist < best[key][1]:
+                best[key] = (doc, dist)
+    return [best[key][0] for key in sorted(scores, key=lambda key: scores[key], reverse=True)]
 
 class SemanticMemory:
     def __init__(self, recent_history_manager: CompressedRecentHistoryManager, persist_directory=None):
@@ -25,17 +467,32 @@ class SemanticMemory:
         for i in persist_directory:
             self.original_memory[i] = SemanticMemoryOriginal(persist_directory, i, name_mapping)
             self.compressed_memory[i] = SemanticMemoryCompressed(persist_directory, i, recent_history_manager, name_mapping)
-        self.reranker = ChatOpenAI(model=RERANKER_MODEL, base_url=OPENROUTER_URL, api_key=OPENROUTER_API_KEY, temperature=0.1)
+        # 重排方式：local（cross-encoder，不可用时退化为嵌入余弦相似度）/ embedding / llm
+        self.rerank_mode = 'local'
+        self.cross_encoder_model = CROSS_ENCODER_MODEL_NAME
+        self.rerank_mode = core_config.get_str('semantic_reranker', self.rerank_mode).lower()
+        self.cross_encoder_model = core_config.get_str('semantic_reranker_model', self.cross_encoder_model)
+        self.reranker = None
+        if self.rerank_mode == 'llm':
+            self.reranker = ChatOpenAI(model=RERANKER_MODEL, base_url=OPENROUTER_URL, api_key=OPENROUTER_API_KEY, temperature=0.1)
 
     def store_conversation(self, event_id, messages, lanlan_name):
         self.original_memory[lanlan_name].store_conversation(event_id, messages)
         self.compressed_memory[lanlan_name].store_compressed_summary(event_id, messages)
 
-    def hybrid_search(self, query, lanlan_name, with_rerank=False, k=10):
-        # 从原始和压缩记忆中获取结果
-        original_results = self.original_memory[lanlan_name].retrieve_by_query(query, k)
-        compressed_results = self.compressed_memory[lanlan_name].retrieve_by_query(query, k)
-        combined = original_results + compressed_results
+    def bulk_ingest(self, lanlan_name, conversations, batch_size=512, checkpoint_path=None, progress=None):
+        """批量写入原始对话（如从归档重建索引），参数见 SemanticMemoryOriginal.bulk_ingest。"""
+        return self.original_memory[lanlan_name].bulk_ingest(
+            conversations, batch_size=batch_size, checkpoint_path=checkpoint_path, progress=progress)
+
+    def hybrid_search(self, query, lanlan_name, with_rerank=False, k=10, start_date=None, end_date=None, approximate=None):
+        # 并行查询原始和压缩记忆，按 event_id 去重并做倒数排名融合；可选的日期范围下推为 where 过滤
+        where = build_date_where(start_date, end_date)
+        original_future = _search_executor.submit(
+            self.original_memory[lanlan_name].retrieve_with_scores, query, k, where, approximate)
+        compressed_future = _search_executor.submit(
+            self.compressed_memory[lanlan_name].retrieve_with_scores, query, k, where, approximate)
+        combined = reciprocal_rank_fusion([original_future.result(), compressed_future.result()])
 
         if with_rerank:
             return self.rerank_results(query, combined)
@@ -50,6 +507,41 @@ class SemanticMemory:
         return f"""======{lanlan_name}尝试回忆=====\n{query}\n\n====={lanlan_name}的相关记忆=====\n{results_text}"""
 
     def rerank_results(self, query, results: list, k=5) -> list:
+        if not results:
+            return []
+        if self.reranker is not None:
+            return self._rerank_with_llm(query, results, k)
+        scores = None
+        if self.rerank_mode != 'embedding' and CrossEncoder is not None:
+            try:
+                model = embedding_service.cross_encoder(self.cross_encoder_model)
+                scores = model.predict([(query, doc.page_content) for doc in results], batch_size=32)
+            except Exception as e:
+                print('Cross-encoder重排失败，改用嵌入相似度', e)
+        if scores is None:
+            scores = self._embedding_scores(query, results)
+        if scores is None:
+            return results[:k]
+        order = np.argsort(-np.asarray(scores, dtype=np.float32), kind='stable')
+        return [results[i] for i in order[:k]]
+
+    @staticmethod
+    def _embedding_scores(query, results):
+        """用共享的（带缓存、批处理的）嵌入函数计算查询与各候选的余弦相似度。"""
+        if embedding_functions is None:
+            return None
+        try:
+            ef = embedding_service.embedding_function()
+            vectors = np.asarray(ef([query] + [doc.page_content for doc in results]), dtype=np.float32)
+        except Exception as e:
+            print('嵌入相似度重排失败', e)
+            return None
+        norms = np.linalg.norm(vectors, axis=1)
+        norms[norms == 0] = 1.0
+        vectors = vectors / norms[:, None]
+        return vectors[1:] @ vectors[0]
+
+    def _rerank_with_llm(self, query, results: list, k=5) -> list:
         # 使用LLM重新排序结果
         results_text = "\n\n".join([
             f"记忆片段 {i + 1}:\n{doc.page_content}"
@@ -79,28 +571,41 @@ class SemanticMemory:
 
 
 class SemanticMemoryOriginal:
-    def __init__(self, persist_directory, lanlan_name, name_mapping):
+    def __init__(self, persist_directory, lanlan_name, name_mapping, reset=False):
+        """reset=True 时先删除该角色已有的原始语义记忆（Chroma 集合或兜底向量库目录），用于从归档完整重建。"""
         base_store_dir = os.path.join(os.path.dirname(__file__), 'store')
         os.makedirs(base_store_dir, exist_ok=True)
         persist_path = os.path.join(base_store_dir, os.path.basename(persist_directory.get(lanlan_name, f"semantic_memory_{lanlan_name}")))
         os.makedirs(persist_path, exist_ok=True)
+        collection_name = f"semantic_{lanlan_name}_original"
+        fallback_path = os.path.join(persist_path, f"fallback_{lanlan_name}_original")
         if chromadb and embedding_functions:
-            client = chromadb.PersistentClient(path=persist_path)
-            ef = embedding_functions.SentenceTransformerEmbeddingFunction(model_name="all-MiniLM-L6-v2")
-            self.vectorstore = _ChromaVectorStore(client, f"semantic_{lanlan_name}_original", ef)
+            client = embedding_service.client(persist_path)
+            if reset:
+                try:
+                    client.delete_collection(collection_name)
+                except Exception:
+                    # 集合不存在
+                    pass
+            ef = embedding_service.embedding_function()
+            self.vectorstore = _ChromaVectorStore(client, collection_name, ef)
         else:
-            self.vectorstore = _InMemoryStore()
+            if reset:
+                shutil.rmtree(fallback_path, ignore_errors=True)
+            self.vectorstore = _InMemoryStore(persist_path=fallback_path)
         self.lanlan_name = lanlan_name
         self.name_mapping = name_mapping
 
-    def store_conversation(self, event_id, messages):
-        # 将对话转换为文本
+    def _conversation_rows(self, event_id, messages, timestamp=None):
+        """把一段对话转换为 (ids, texts, metadatas)；id 由 event_id 与消息序号决定，重复写入是幂等的。"""
+        ids = []
         texts = []
         metadatas = []
         name_mapping = self.name_mapping.copy()
         name_mapping['ai'] = self.lanlan_name
+        time_meta = _time_metadata(timestamp or datetime.now())
 
-        for message in messages:
+        for idx, message in enumerate(messages):
             try:
                 parts = []
                 for i in message.content:
@@ -111,26 +616,66 @@ class SemanticMemoryOriginal:
                 joined = "\n".join(parts)
             except Exception:
                 joined = str(message.content)
-            texts.append(f"{name_mapping[message.type]} | {joined}\n")
-            metadatas.append({
-                "event_id": event_id,
-                "role": message.type,
-                "year": str(datetime.now().year),
-                "month": "%02d" % (datetime.now().month),
-                "day": "%02d" % (datetime.now().day),
-                "weekday": "%02d" % (datetime.now().weekday()),
-                "hour": "%02d" % (datetime.now().hour),
-                "minute": "%02d" % (datetime.now().minute),
-                "timestamp": datetime.now().isoformat()
-            })
+            ids.append(f"{event_id}:{idx}")
+            texts.append(f"{name_mapping.get(message.type, message.type)} | {joined}\n")
+            metadatas.append({"event_id": event_id, "role": message.type, **time_meta})
+        return ids, texts, metadatas
 
+    def store_conversation(self, event_id, messages, timestamp=None):
+        ids, texts, metadatas = self._conversation_rows(event_id, messages, timestamp)
         # 存储到向量数据库
-        self.vectorstore.add_texts(texts=texts, metadatas=metadatas)
+        self.vectorstore.add_texts(texts=texts, metadatas=metadatas, ids=ids)
+
+    def bulk_ingest(self, conversations, batch_size=512, checkpoint_path=None, progress=None):
+        """
+        批量写入多段对话，用于从归档重建索引（例如更换嵌入模型之后）。
+        - conversations: 可迭代的 (event_id, messages, timestamp)
+        - 按 batch_size 条消息为一批写入，id 确定，重复执行不会产生重复记录
+        - checkpoint_path: 每写完一批就追加记录已完成的 event_id，再次运行时跳过，实现断点续跑
+        - progress: 可选回调 progress(已写入对话数, 已写入消息数)
+        返回本次写入的 (对话数, 消息数)。
+        """
+        done = set()
+        if checkpoint_path and os.path.exists(checkpoint_path):
+            with open(checkpoint_path, 'r', encoding='utf-8') as f:
+                done = {line.strip() for line in f if line.strip()}
+        batch_ids, batch_texts, batch_metas, batch_events = [], [], [], []
+        n_conversations = n_messages = 0
+
+        def _flush():
+            nonlocal n_conversations, n_messages
+            if not batch_ids:
+                return
+            self.vectorstore.add_texts(texts=batch_texts, metadatas=batch_metas, ids=batch_ids)
+            if checkpoint_path:
+                with open(checkpoint_path, 'a', encoding='utf-8') as f:
+                    f.write("".join(f"{e}\n" for e in batch_events))
+            n_conversations += len(batch_events)
+            n_messages += len(batch_ids)
+            batch_ids.clear(); batch_texts.clear(); batch_metas.clear(); batch_events.clear()
+            if progress:
+                progress(n_conversations, n_messages)
+
+        for event_id, messages, timestamp in conversations:
+            if event_id in done:
+                continue
+            ids, texts, metadatas = self._conversation_rows(event_id, messages, timestamp)
+            batch_ids.extend(ids)
+            batch_texts.extend(texts)
+            batch_metas.extend(metadatas)
+            batch_events.append(event_id)
+            if len(batch_ids) >= batch_size:
+                _flush()
+        _flush()
+        return n_conversations, n_messages
 
     def retrieve_by_query(self, query, k=10):
         # 在原始对话上进行精确语义搜索
         return self.vectorstore.similarity_search(query, k=k)
 
+    def retrieve_with_scores(self, query, k=10, where=None, approximate=None):
+        return self.vectorstore.similarity_search_with_score(query, k=k, where=where, approximate=approximate)
+
 
 class SemanticMemoryCompressed:
     def __init__(self, persist_directory, lanlan_name, recent_history_manager: CompressedRecentHistoryManager, name_mapping):
@@ -141,37 +686,31 @@ class SemanticMemoryCompressed:
         persist_path = os.path.join(base_store_dir, os.path.basename(persist_directory.get(lanlan_name, f"semantic_memory_{lanlan_name}")))
         os.makedirs(persist_path, exist_ok=True)
         if chromadb and embedding_functions:
-            client = chromadb.PersistentClient(path=persist_path)
-            ef = embedding_functions.SentenceTransformerEmbeddingFunction(model_name="all-MiniLM-L6-v2")
+            client = embedding_service.client(persist_path)
+            ef = embedding_service.embedding_function()
             self.vectorstore = _ChromaVectorStore(client, f"semantic_{lanlan_name}_compressed", ef)
         else:
-            self.vectorstore = _InMemoryStore()
+            self.vectorstore = _InMemoryStore(persist_path=os.path.join(persist_path, f"fallback_{lanlan_name}_compressed"))
         self.recent_history_manager = recent_history_manager
 
     def store_compressed_summary(self, event_id, messages):
         # 存储压缩摘要的嵌入
-        _, summary = self.recent_history_manager.compress_history(messages, self.lanlan_name)
+        _, summary = self.recent_history_manager.summarize_event(event_id, messages, self.lanlan_name)
         if not summary:
             return
         self.vectorstore.add_texts(
             texts=[summary],
-            metadatas=[{
-                "event_id": event_id,
-                "role": "SYSTEM_SUMMARY",
-                "year": str(datetime.now().year),
-                "month": "%02d" % (datetime.now().month),
-                "day": "%02d" % (datetime.now().day),
-                "weekday": "%02d" % (datetime.now().weekday()),
-                "hour": "%02d" % (datetime.now().hour),
-                "minute": "%02d" % (datetime.now().minute),
-                "timestamp": datetime.now().isoformat()
-            }]
+            metadatas=[{"event_id": event_id, "role": "SYSTEM_SUMMARY", **_time_metadata(datetime.now())}],
+            ids=[f"{event_id}:summary"]
         )
 
     def retrieve_by_query(self, query, k=10):
         # 在压缩摘要上进行语义搜索
         return self.vectorstore.similarity_search(query, k=k)
 
+    def retrieve_with_scores(self, query, k=10, where=None, approximate=None):
+        return self.vectorstore.similarity_search_with_score(query, k=k, where=where, approximate=approximate)
+
 
 class _ChromaVectorStore:
     def __init__(self, client, collection_name: str, embedding_function):
@@ -180,34 +719,451 @@ class _ChromaVectorStore:
             embedding_function=embedding_function
         )
 
-    def add_texts(self, texts: List[str], metadatas: List[dict]):
-        import uuid
-        ids = [str(uuid.uuid4()) for _ in texts]
-        self.collection.add(documents=texts, metadatas=metadatas, ids=ids)
+    def add_texts(self, texts: List[str], metadatas: List[dict], ids: List[str] | None = None):
+        if not texts:
+            return
+        if ids is None:
+            import uuid
+            ids = [str(uuid.uuid4()) for _ in texts]
+            self.collection.add(documents=texts, metadatas=metadatas, ids=ids)
+        else:
+            # 确定性 id 使用 upsert，重复写入同一批数据是幂等的
+            self.collection.upsert(documents=texts, metadatas=metadatas, ids=ids)
+
+    def similarity_search(self, query: str, k: int = 10, where: dict | None = None, approximate: bool | None = None) -> List[Document]:
+        return [doc for doc, _ in self.similarity_search_with_score(query, k=k, where=where, approximate=approximate)]
 
-    def similarity_search(self, query: str, k: int = 10) -> List[Document]:
-        results = self.collection.query(query_texts=[query], n_results=k)
+    def similarity_search_with_score(self, query: str, k: int = 10, where: dict | None = None, approximate: bool | None = None) -> List[tuple]:
+        # Chroma 内部始终使用 HNSW 近似检索，approximate 参数仅为与内存后端保持接口一致
+        kwargs = {"query_texts": [query], "n_results": k}
+        if where:
+            kwargs["where"] = where
+        results = self.collection.query(**kwargs)
         docs = []
         if results and results.get('documents'):
             documents = results['documents'][0]
-            metadatas = results.get('metadatas', [[]])[0]
+            metadatas = (results.get('metadatas') or [[]])[0] or []
+            distances = (results.get('distances') or [[]])[0] or []
             for i, content in enumerate(documents):
                 meta = metadatas[i] if i < len(metadatas) else {}
-                docs.append(Document(page_content=content, metadata=meta))
+                distance = distances[i] if i < len(distances) else None
+                docs.append((Document(page_content=content, metadata=meta or {}), distance))
         return docs
 
+class _NumpyVectorIndex:
+    """
+    精确的内存向量索引：归一化的 float32 矩阵，点积打分，argpartition 取 top-k。
+    已落盘的向量以只读 memmap 打开（百万级向量也不必整体读入内存），新增向量放在按倍数扩容的尾部数组，
+    并以原始 float32 追加写入 vectors.f32。
+    """
+    def __init__(self, persist_dir=None):
+        self.dim = None
+        self.persist_dir = persist_dir
+        self._base = None
+        self._tail = None
+        self._tail_n = 0
+        if persist_dir:
+            self._load()
+
+    def _vectors_path(self):
+        return os.path.join(self.persist_dir, 'vectors.f32')
+
+    def _meta_path(self):
+        return os.path.join(self.persist_dir, 'index.json')
+
+    def _load(self):
+        try:
+            with open(self._meta_path(), 'r', encoding='utf-8') as f:
+                self.dim = int(json.load(f)['dim'])
+        except (FileNotFoundError, KeyError, ValueError):
+            return
+        path = self._vectors_path()
+        if not os.path.exists(path):
+            return
+        n = os.path.getsize(path) // (4 * self.dim)
+        if n > 0:
+            self._base = np.memmap(path, dtype=np.float32, mode='r', shape=(n, self.dim))
+
+    def __len__(self):
+        return (0 if self._base is None else len(self._base)) + self._tail_n
+
+    def truncate(self, n):
+        """丢弃 n 之后的向量（用于崩溃后与文档文件对齐）。"""
+        if n >= len(self):
+            return
+        base_n = 0 if self._base is None else len(self._base)
+        if n <= base_n:
+            base_n = n
+            self._tail_n = 0
+        else:
+            self._tail_n = n - base_n
+        if not (self.persist_dir and self.dim):
+            self._base = self._base[:base_n] if base_n > 0 else None
+            return
+        # Windows 上无法截断仍被映射的文件：先释放 memmap，截断后再重新映射
+        self._base = None
+        path = self._vectors_path()
+        with open(path, 'r+b') as f:
+            f.truncate(n * 4 * self.dim)
+        if base_n > 0:
+            self._base = np.memmap(path, dtype=np.float32, mode='r', shape=(base_n, self.dim))
+
+    def add(self, vectors):
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if vectors.ndim != 2 or len(vectors) == 0:
+            return
+        if self.dim is None:
+            self.dim = vectors.shape[1]
+            if self.persist_dir:
+                os.makedirs(self.persist_dir, exist_ok=True)
+                with open(self._meta_path(), 'w', encoding='utf-8') as f:
+                    json.dump({"dim": self.dim}, f)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        vectors = vectors / norms
+        needed = self._tail_n + len(vectors)
+        if self._tail is None or needed > len(self._tail):
+            capacity = max(1024, needed, 2 * (0 if self._tail is None else len(self._tail)))
+            grown = np.empty((capacity, self.dim), dtype=np.float32)
+            if self._tail_n:
+                grown[:self._tail_n] = self._tail[:self._tail_n]
+            self._tail = grown
+        self._tail[self._tail_n:needed] = vectors
+        self._tail_n = needed
+        if self.persist_dir:
+            with open(self._vectors_path(), 'ab') as f:
+                f.write(vectors.tobytes())
+
+    def rows(self, ids):
+        """按全局下标取出向量（跨 memmap 基础段与内存尾部）。"""
+        ids = np.asarray(ids, dtype=np.int64)
+        base_n = 0 if self._base is None else len(self._base)
+        out = np.empty((len(ids), self.dim or 0), dtype=np.float32)
+        in_base = ids < base_n
+        if in_base.any():
+            out[in_base] = self._base[ids[in_base]]
+        if (~in_base).any():
+            out[~in_base] = self._tail[ids[~in_base] - base_n]
+        return out
+
+    def iter_chunks(self, start=0, stop=None, chunk=65536):
+        """按块遍历 [start, stop) 的向量，产出 (起始下标, 向量块)。"""
+        stop = len(self) if stop is None else stop
+        for lo in range(start, stop, chunk):
+            hi = min(lo + chunk, stop)
+            yield lo, self.rows(np.arange(lo, hi))
+
+    def scores(self, query_vector):
+        q = np.asarray(query_vector, dtype=np.float32)
+        norm = np.linalg.norm(q)
+        if norm > 0:
+            q = q / norm
+        parts = []
+        if self._base is not None:
+            parts.append(self._base @ q)
+        if self._tail_n:
+            parts.append(self._tail[:self._tail_n] @ q)
+        return np.concatenate(parts) if parts else np.zeros(0, dtype=np.float32)
+
+    def search(self, query_vector, k, mask=None):
+        """返回 (下标数组, 余弦相似度数组)，按相似度降序；mask 为布尔数组时只在其为 True 的位置中检索。"""
+        scores = self.scores(query_vector)
+        if mask is not None:
+            scores = np.where(mask, scores, -np.inf)
+            valid = int(mask.sum())
+        else:
+            valid = len(scores)
+        k = min(k, valid)
+        if k <= 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+        idx = np.argpartition(-scores, k - 1)[:k]
+        idx = idx[np.argsort(-scores[idx], kind='stable')]
+        return idx, scores[idx]
+
+
+def _normalize_query(query_vector):
+    q = np.asarray(query_vector, dtype=np.float32)
+    norm = np.linalg.norm(q)
+    return q / norm if norm > 0 else q
+
+
+class _IVFIndex:
+    """
+    纯 NumPy 的倒排（IVF）近似索引：球面 k-means 得到 nlist 个中心，每个向量记录所属中心；
+    查询时只对最近的 nprobe 个中心内的候选做精确打分。向量本身仍存放在精确索引中。
+    """
+    def __init__(self, exact, nlist=None, nprobe=16):
+        self.exact = exact
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.centroids = None
+        self._assign = np.zeros(0, dtype=np.int32)
+
+    def build(self, n, sample_size=50_000, iterations=10, seed=0):
+        rng = np.random.default_rng(seed)
+        nlist = self.nlist or max(16, int(np.sqrt(n)))
+        sample_ids = np.sort(rng.choice(n, size=min(n, max(sample_size, nlist)), replace=False))
+        sample = self.exact.rows(sample_ids)
+        centroids = sample[rng.choice(len(sample), size=min(nlist, len(sample)), replace=False)].copy()
+        for _ in range(iterations):
+            labels = np.argmax(sample @ centroids.T, axis=1)
+            for c in range(len(centroids)):
+                members = sample[labels == c]
+                if len(members):
+                    centroid = members.sum(axis=0)
+                    norm = np.linalg.norm(centroid)
+                    if norm > 0:
+                        centroids[c] = centroid / norm
+        self.centroids = centroids
+        self._assign = np.zeros(0, dtype=np.int32)
+        self.add_range(0, n)
+
+    def add_range(self, start, stop):
+        parts = [self._assign[:start]]
+        for _, chunk in self.exact.iter_chunks(start, stop):
+            parts.append(np.argmax(chunk @ self.centroids.T, axis=1).astype(np.int32))
+        self._assign = np.concatenate(parts)
+
+    def __len__(self):
+        return len(self._assign)
+
+    def search(self, query_vector, k, mask=None, nprobe=None):
+        q = _normalize_query(query_vector)
+        nprobe = min(nprobe or self.nprobe, len(self.centroids))
+        probes = np.argpartition(-(self.centroids @ q), nprobe - 1)[:nprobe]
+        candidates = np.flatnonzero(np.isin(self._assign, probes))
+        if mask is not None:
+            candidates = candidates[mask[candidates]]
+        if len(candidates) == 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+        scores = self.exact.rows(candidates) @ q
+        k = min(k, len(candidates))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top], kind='stable')]
+        return candidates[top], scores[top]
+
+
+class _HNSWIndex:
+    """hnswlib 的 HNSW 图索引（内积空间，向量已归一化），支持增量插入。"""
+    def __init__(self, exact, m=16, ef_construction=200, ef_search=64):
+        self.exact = exact
+        self.m = m
+        self.ef_construction = ef_construction
+        self.ef_search = ef_search
+        self._index = None
+        self._count = 0
+
+    def build(self, n):
+        index = hnswlib.Index(space='ip', dim=self.exact.dim)
+        index.init_index(max_elements=max(1024, 2 * n), ef_construction=self.ef_construction, M=self.m)
+        index.set_ef(self.ef_search)
+        self._index = index
+        self._count = 0
+        self.add_range(0, n)
+
+    def add_range(self, start, stop):
+        for lo, chunk in self.exact.iter_chunks(start, stop):
+            needed = lo + len(chunk)
+            if needed > self._index.get_max_elements():
+                self._index.resize_index(2 * needed)
+            self._index.add_items(chunk, np.arange(lo, lo + len(chunk)))
+        self._count = max(self._count, stop)
+
+    def __len__(self):
+        return self._count
+
+    def search(self, query_vector, k, mask=None, nprobe=None):
+        q = _normalize_query(query_vector)
+        k = min(k, self._count)
+        if k <= 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+        # 有过滤条件时多取一些再后过滤
+        fetch = min(self._count, k * 4 if mask is not None else k)
+        self._index.set_ef(max(self.ef_search, fetch))
+        labels, distances = self._index.knn_query(q, k=fetch)
+        ids = labels[0].astype(np.int64)
+        sims = 1.0 - distances[0]
+        if mask is not None:
+            keep = mask[ids]
+            ids, sims = ids[keep], sims[keep]
+        return ids[:k], sims[:k].astype(np.float32)
+
+
+class _AnnTier:
+    """
+    精确索引之上的可选近似索引层：向量数达到 min_size 后在后台线程构建，
+    新向量增量插入；IVF 在数据量翻倍后后台重训。构建期间查询自动走精确检索。
+    backend: 'auto'（有 hnswlib 用 HNSW，否则 IVF）/ 'hnsw' / 'ivf' / 'off'
+    """
+    def __init__(self, exact, backend='auto', min_size=20_000):
+        self.exact = exact
+        if backend == 'auto':
+            backend = 'hnsw' if hnswlib is not None else 'ivf'
+        if backend == 'hnsw' and hnswlib is None:
+            backend = 'ivf'
+        self.backend = backend
+        self.min_size = min_size
+        self._index = None
+        self._built_size = 0
+        self._building = False
+        self._lock = threading.Lock()
+
+    @property
+    def ready(self):
+        return self._index is not None
+
+    def _new_index(self):
+        return _HNSWIndex(self.exact) if self.backend == 'hnsw' else _IVFIndex(self.exact)
+
+    def on_add(self):
+        """精确索引追加向量后调用：增量插入或按需触发后台（重）建。"""
+        if self.backend == 'off':
+            return
+        n = len(self.exact)
+        with self._lock:
+            if self._index is not None and len(self._index) < n:
+                self._index.add_range(len(self._index), n)
+            needs_build = (self._index is None and n >= self.min_size) or \
+                (self.backend == 'ivf' and self._index is not None and n >= 2 * self._built_size)
+            if not needs_build or self._building:
+                return
+            self._building = True
+        threading.Thread(target=self._build, args=(n,), name="ann-rebuild", daemon=True).start()
+
+    def rebuild(self, wait=False):
+        """手动触发重建；wait=True 时在当前线程同步完成。"""
+        with self._lock:
+            if self._building:
+                return
+            self._building = True
+        n = len(self.exact)
+        if wait:
+            self._build(n)
+        else:
+            threading.Thread(target=self._build, args=(n,), name="ann-rebuild", daemon=True).start()
+
+    def _build(self, n):
+        try:
+            index = self._new_index()
+            index.build(n)
+            with self._lock:
+                # 追上构建期间新增的向量后原子替换
+                total = len(self.exact)
+                if total > n:
+                    index.add_range(n, total)
+                self._index = index
+                self._built_size = total
+        except Exception as e:
+            print("构建近似向量索引失败：", e)
+        finally:
+            self._building = False
+
+    def search(self, query_vector, k, mask=None):
+        index = self._index
+        if index is None:
+            return None
+        return index.search(query_vector, k, mask=mask)
+
+
 class _InMemoryStore:
-    def __init__(self):
+    """
+    Chroma 不可用时的兜底向量库：NumPy 精确向量检索，可选持久化（文档写入 docs.jsonl，向量写入 vectors.f32）。
+    返回的距离为余弦距离 1 - cos。
+    """
+    # 近似索引后端，见 _AnnTier
+    ann_backend = 'auto'
+
+    def __init__(self, embedding_function=None, persist_path=None):
         self._docs = []
+        self._ids = set()
+        self._embed = embedding_function or embedding_service.local_embedding_function()
+        self.persist_path = persist_path
+        self._lock = threading.Lock()
+        self._index = _NumpyVectorIndex(persist_dir=persist_path)
+        if persist_path:
+            self._load_docs()
+        self._ann = _AnnTier(self._index, backend=self.ann_backend)
+        self._ann.on_add()
+
+    def _docs_path(self):
+        return os.path.join(self.persist_path, 'docs.jsonl')
+
+    def _load_docs(self):
+        ids = []
+        try:
+            with open(self._docs_path(), 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        rec = json.loads(line)
+                    except Exception:
+                        break
+                    self._docs.append(Document(page_content=rec.get('text', ''), metadata=rec.get('metadata') or {}))
+                    ids.append(rec.get('id'))
+        except FileNotFoundError:
+            # 向量已写入、文档文件尚未创建时崩溃：下面会把向量截断为 0 条
+            pass
+        # 进程中途退出可能导致文档与向量条数不一致，以较短者为准
+        n = min(len(self._docs), len(self._index))
+        if len(self._docs) > n:
+            self._docs = self._docs[:n]
+            ids = ids[:n]
+            with open(self._docs_path(), 'w', encoding='utf-8') as f:
+                for doc_id, d in zip(ids, self._docs):
+                    f.write(json.dumps({"id": doc_id, "text": d.page_content, "metadata": d.metadata}, ensure_ascii=False) + "\n")
+        self._index.truncate(n)
+        self._ids = {doc_id for doc_id in ids if doc_id is not None}
 
-    def add_texts(self, texts: List[str], metadatas: List[dict]):
+    def add_texts(self, texts: List[str], metadatas: List[dict], ids: List[str] | None = None):
+        if ids is not None:
+            # 已存在的 id 直接跳过，使按确定性 id 的重复写入保持幂等
+            keep = []
+            seen = set()
+            for i, doc_id in enumerate(ids):
+                if doc_id not in self._ids and doc_id not in seen:
+                    seen.add(doc_id)
+                    keep.append(i)
+            texts = [texts[i] for i in keep]
+            metadatas = [metadatas[i] if i < len(metadatas) else {} for i in keep]
+            ids = [ids[i] for i in keep]
+        if not texts:
+            return
+        vectors = self._embed(list(texts))
+        docs = []
         for i, t in enumerate(texts):
             meta = metadatas[i] if i < len(metadatas) else {}
-            self._docs.append(Document(page_content=t, metadata=meta))
-
-    def similarity_search(self, query: str, k: int = 10) -> List[Document]:
-        q = (query or "").lower()
-        filtered = [d for d in self._docs if q and q in (d.page_content or "").lower()]
-        if not filtered:
-            filtered = list(self._docs)
-        return filtered[-k:]
+            docs.append(Document(page_content=t, metadata=meta))
+        ids = ids if ids is not None else [None] * len(docs)
+        with self._lock:
+            self._index.add(vectors)
+            self._docs.extend(docs)
+            self._ids.update(doc_id for doc_id in ids if doc_id is not None)
+            self._ann.on_add()
+            if self.persist_path:
+                os.makedirs(self.persist_path, exist_ok=True)
+                with open(self._docs_path(), 'a', encoding='utf-8') as f:
+                    for doc_id, d in zip(ids, docs):
+                        f.write(json.dumps({"id": doc_id, "text": d.page_content, "metadata": d.metadata}, ensure_ascii=False) + "\n")
+
+    def similarity_search(self, query: str, k: int = 10, where: dict | None = None, approximate: bool | None = None) -> List[Document]:
+        return [doc for doc, _ in self.similarity_search_with_score(query, k=k, where=where, approximate=approximate)]
+
+    def similarity_search_with_score(self, query: str, k: int = 10, where: dict | None = None, approximate: bool | None = None) -> List[tuple]:
+        """approximate: None 表示近似索引就绪时使用，True 优先近似，False 强制精确检索。"""
+        if not self._docs:
+            return []
+        query_vector = self._embed([query or ""])[0]
+        with self._lock:
+            n = len(self._docs)
+            mask = None
+            if where:
+                mask = np.fromiter((_match_where(d.metadata, where) for d in self._docs), dtype=bool, count=n)
+            result = None
+            if approximate is not False:
+                result = self._ann.search(query_vector, k, mask=mask)
+                # 过滤后近似结果不足 k 条时回退到精确检索
+                if result is not None and len(result[0]) < min(k, n if mask is None else int(mask.sum())):
+                    result = None
+            if result is None:
+                result = self._index.search(query_vector, k, mask=mask)
+            idx, sims = result
+            return [(self._docs[i], float(1.0 - s)) for i, s in zip(idx, sims)]
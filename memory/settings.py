@@ -1,10 +1,49 @@
+import os
+import re
 import json
+import time
+import threading
 from langchain_openai import ChatOpenAI
 from config import OPENROUTER_API_KEY, SETTING_PROPOSER_MODEL, SETTING_VERIFIER_MODEL, OPENROUTER_URL, get_character_data
 from config.prompts_sys import settings_extractor_prompt, settings_verifier_prompt
+from config.core_config import core_config
+
+# 可能包含个人设定的用户发言线索；一批对话里一条都没有时不必调用模型
+_SETTING_CUES = (
+    "我是", "我叫", "叫我", "名字", "我喜欢", "我不喜欢", "最喜欢", "我爱", "我讨厌", "我怕", "过敏",
+    "我的", "我家", "我住", "我在", "我今年", "生日", "工作", "习惯", "养了", "记住", "记得", "以后",
+    "i am", "i'm", "my ", "call me", "i like", "i love", "i hate", "remember", "birthday",
+)
+
+
+def _message_text(msg):
+    if isinstance(getattr(msg, 'content', None), str):
+        return msg.content
+    try:
+        parts = []
+        for i in msg.content:
+            if isinstance(i, dict):
+                parts.append(i.get("text", f"|{i.get('type','')}|"))
+            else:
+                parts.append(str(i))
+        return "\n".join(parts)
+    except Exception:
+        return str(getattr(msg, 'content', ''))
+
+
+def _bigrams(text):
+    # 中文按字、英文按词切分后取相邻二元组，足以粗略判断一句话是否已被设定覆盖
+    units = re.findall(r'[\u4e00-\u9fff]|[a-z0-9]+', text.lower())
+    return set(zip(units, units[1:]))
 
 
 class ImportantSettingsManager:
+    # 设定提取的批处理：攒够 extract_max_turns 轮用户发言，或距上次提取超过 extract_interval_sec 秒才调用模型
+    extract_interval_sec = 600
+    extract_max_turns = 20
+    # 线索句的二元组与已有设定的重合比例不低于此值时，视为没有新信息
+    novelty_overlap_threshold = 0.8
+
     def __init__(self, settings_file=None):
         _, _, master_basic_config, lanlan_basic_config, name_mapping, _, _, _, setting_store, _ = get_character_data()
         self.settings_file = settings_file if settings_file is not None else setting_store
@@ -22,22 +61,62 @@ class ImportantSettingsManager:
             self.proposer = None
             self.verifier = None
         self.settings = {}
+        # 每个角色设定文件的 (mtime_ns, size)，未变化时直接复用已解析并合并过基础设定的结果
+        self._file_sig = {}
+        self._pending = {}
+        self._pending_turns = {}
+        self._batch_started = {}
+        self._extract_locks = {}
+        self._extract_locks_guard = threading.Lock()
         self.master_basic_config = master_basic_config
         self.lanlan_basic_config = lanlan_basic_config
         self.name_mapping = name_mapping
         self.load_settings()
 
+    @staticmethod
+    def _stat(path):
+        try:
+            st = os.stat(path)
+            return st.st_mtime_ns, st.st_size
+        except OSError:
+            return None
+
+    def _load_one(self, lanlan_name):
+        path = self.settings_file[lanlan_name]
+        sig = self._stat(path)
+        if lanlan_name in self.settings and self._file_sig.get(lanlan_name, False) == sig:
+            return
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                settings = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            settings = {lanlan_name: dict(self.lanlan_basic_config[lanlan_name]), self.name_mapping['human']: dict(self.master_basic_config)}
+        self.settings[lanlan_name] = self._merge_basic_config(settings, lanlan_name)
+        self._file_sig[lanlan_name] = sig
+
+    def _merge_basic_config(self, settings, lanlan_name):
+        # 基础设定始终覆盖到缓存/落盘的设定上：加载后合并一次，保存前（如校验模型改写整份设定后）再合并一次
+        if not isinstance(settings, dict):
+            settings = {}
+        for key, basic in ((lanlan_name, self.lanlan_basic_config[lanlan_name]), (self.name_mapping['human'], self.master_basic_config)):
+            if not isinstance(settings.get(key), dict):
+                settings[key] = {}
+            settings[key].update(basic)
+        return settings
+
     def load_settings(self):
         for i in self.settings_file:
-            try:
-                with open(self.settings_file[i], 'r', encoding='utf-8') as f:
-                    self.settings[i] = json.load(f)
-            except (FileNotFoundError, json.JSONDecodeError):
-                self.settings[i] = {i: self.lanlan_basic_config[i], self.name_mapping['human']: self.master_basic_config}
+            self._load_one(i)
 
     def save_settings(self, lanlan_name):
-        with open(self.settings_file[lanlan_name], 'w', encoding='utf-8') as f:
+        # 先写临时文件再原子替换，读者不会看到写了一半的 JSON
+        path = self.settings_file[lanlan_name]
+        self.settings[lanlan_name] = self._merge_basic_config(self.settings[lanlan_name], lanlan_name)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
             json.dump(self.settings[lanlan_name], f, indent=2, ensure_ascii=False)
+        os.replace(tmp_path, path)
+        self._file_sig[lanlan_name] = self._stat(path)
 
     def detect_and_resolve_contradictions(self, old_settings, new_settings, lanlan_name):
         # 使用LLM检测矛盾并解决它们
@@ -70,19 +149,7 @@ class ImportantSettingsManager:
             return
         name_mapping = self.name_mapping.copy()
         name_mapping['ai'] = lanlan_name
-        lines = []
-        for msg in messages:
-            try:
-                parts = []
-                for i in msg.content:
-                    if isinstance(i, dict):
-                        parts.append(i.get("text", f"|{i.get('type','')}|"))
-                    else:
-                        parts.append(str(i))
-                joined = "\n".join(parts)
-            except Exception:
-                joined = str(getattr(msg, 'content', ''))
-            lines.append(f"{name_mapping[msg.type]} | {joined}")
+        lines = [f"{name_mapping[msg.type]} | {_message_text(msg)}" for msg in messages]
         prompt = settings_extractor_prompt % ("\n".join(lines))
         prompt = prompt.replace('{LANLAN_NAME}', lanlan_name)
         retries = 0
@@ -106,12 +173,65 @@ class ImportantSettingsManager:
 
         # 检测并解决矛盾
         if len(new_settings)>0:
-            self.load_settings()
+            self._load_one(lanlan_name)
             self.settings[lanlan_name] = self.detect_and_resolve_contradictions(self.settings[lanlan_name], new_settings, lanlan_name)
             self.save_settings(lanlan_name)
 
+    def _extract_lock(self, lanlan_name):
+        with self._extract_locks_guard:
+            return self._extract_locks.setdefault(lanlan_name, threading.RLock())
+
+    def _has_new_information(self, messages, lanlan_name):
+        """本地预筛：只有用户发言中出现设定线索、且该句大部分内容尚未出现在已有设定里时才值得提取。"""
+        cue_lines = [t for t in (_message_text(m) for m in messages if m.type == 'human')
+                     if any(c in t.lower() for c in _SETTING_CUES)]
+        if not cue_lines:
+            return False
+        known = _bigrams(json.dumps(self.get_settings(lanlan_name), ensure_ascii=False))
+        for line in cue_lines:
+            grams = _bigrams(line)
+            if grams and len(grams & known) / len(grams) < self.novelty_overlap_threshold:
+                return True
+        return False
+
+    def extraction_enabled(self):
+        # 设定提取会额外调用提取与校验两次模型，需要在 core_config.json 中显式开启
+        return self.proposer is not None and core_config.get_bool('settings_extraction_enabled', False)
+
+    def submit_conversation(self, messages, lanlan_name, force=False):
+        """
+        累积一段对话，到达轮数或时间阈值时把整批对话合并为一次设定提取。
+        时间阈值从本批第一段对话进入时开始计算；force=True 时立即处理已累积的内容。
+        没有新信息的批次直接丢弃，不调用模型。
+        """
+        if not self.extraction_enabled():
+            return
+        with self._extract_lock(lanlan_name):
+            pending = self._pending.setdefault(lanlan_name, [])
+            now = time.monotonic()
+            if messages and not pending:
+                self._batch_started[lanlan_name] = now
+            pending.extend(messages)
+            turns = self._pending_turns.get(lanlan_name, 0) + sum(1 for m in messages if m.type == 'human')
+            self._pending_turns[lanlan_name] = turns
+            started = self._batch_started.get(lanlan_name, now)
+            if not pending or not (force or turns >= self.extract_max_turns or now - started >= self.extract_interval_sec):
+                return
+            self._pending[lanlan_name] = []
+            self._pending_turns[lanlan_name] = 0
+            if self._has_new_information(pending, lanlan_name):
+                self.extract_and_update_settings(pending, lanlan_name)
+
+    def flush_due(self):
+        """处理已到时间阈值的批次；由后台定时调用，角色安静下来后最后一批也会被提取。"""
+        for name in list(self._pending):
+            self.submit_conversation([], name)
+
+    def flush_pending(self, lanlan_name=None):
+        """立即处理累积的对话（lanlan_name 为 None 时处理所有角色）。"""
+        for name in ([lanlan_name] if lanlan_name is not None else list(self._pending)):
+            self.submit_conversation([], name, force=True)
+
     def get_settings(self, lanlan_name):
-        self.load_settings()
-        self.settings[lanlan_name][lanlan_name].update(self.lanlan_basic_config[lanlan_name])
-        self.settings[lanlan_name][self.name_mapping['human']].update(self.master_basic_config)
-        return self.settings[lanlan_name]
\ No newline at end of file
+        self._load_one(lanlan_name)
+        return self.settings[lanlan_name]
@@ -1,9 +1,42 @@
 from langchain_community.chat_message_histories import SQLChatMessageHistory
-from langchain_core.messages import SystemMessage
-from sqlalchemy import create_engine, text
-from config import TIME_ORIGINAL_TABLE_NAME, TIME_COMPRESSED_TABLE_NAME, get_character_data
+from langchain_core.messages import SystemMessage, message_to_dict
+from sqlalchemy import create_engine, event, text
+from config import TIME_ORIGINAL_TABLE_NAME, TIME_COMPRESSED_TABLE_NAME, TIME_DAILY_TABLE_NAME, get_character_data
 import os
-from datetime import datetime
+import json
+from datetime import datetime, timedelta
+
+
+def _sqlite_pragmas(dbapi_connection, connection_record):
+    # WAL 让读写互不阻塞；NORMAL 在 WAL 下仍能保证崩溃后数据库一致
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA busy_timeout=5000")
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.close()
+
+
+# (索引名后缀, 列) —— 时间范围检索走 timestamp；按会话删除/查询走复合索引的 session_id 前缀
+_TABLE_INDEXES = (
+    ("timestamp", "timestamp"),
+    ("session_timestamp", "session_id, timestamp"),
+)
+
+
+def create_time_indexes(conn, table_name):
+    """为时间索引表建立索引，可重复执行。"""
+    for suffix, columns in _TABLE_INDEXES:
+        conn.execute(text(f"CREATE INDEX IF NOT EXISTS idx_{table_name}_{suffix} ON {table_name} ({columns})"))
+
+
+def _day_str(value):
+    return value if isinstance(value, str) else value.strftime('%Y-%m-%d')
+
+
+def _insert_sql(table_name):
+    return text(f"INSERT INTO {table_name} (session_id, message, timestamp) VALUES (:session_id, :message, :timestamp)")
+
 
 class TimeIndexedMemory:
     def __init__(self, recent_history_manager):
@@ -20,6 +53,7 @@ class TimeIndexedMemory:
             # 确保父目录存在
             os.makedirs(os.path.dirname(abs_path), exist_ok=True)
             self.engine[i] = create_engine(f"sqlite:///{abs_path}")
+            event.listen(self.engine[i], "connect", _sqlite_pragmas)
 
             _ = SQLChatMessageHistory(
                 connection=self.engine[i],
@@ -44,40 +78,213 @@ class TimeIndexedMemory:
         with self.engine[lanlan_name].connect() as conn:
             result = conn.execute(text(f"PRAGMA table_info({TIME_ORIGINAL_TABLE_NAME})"))
             columns = result.fetchall()
-            for i in columns:
-                if i[1] == 'timestamp':
-                    return
+        if not any(i[1] == 'timestamp' for i in columns):
             self.add_timestamp_column(lanlan_name)
+        with self.engine[lanlan_name].begin() as conn:
+            create_time_indexes(conn, TIME_ORIGINAL_TABLE_NAME)
+            create_time_indexes(conn, TIME_COMPRESSED_TABLE_NAME)
+            conn.execute(text(
+                f"CREATE TABLE IF NOT EXISTS {TIME_DAILY_TABLE_NAME} ("
+                f"day TEXT PRIMARY KEY, message_count INTEGER NOT NULL, session_count INTEGER NOT NULL, "
+                f"participants TEXT NOT NULL, summary TEXT NOT NULL)"
+            ))
+            # 旧库第一次升级时，从原始记录回填全部日汇总
+            if conn.execute(text(f"SELECT 1 FROM {TIME_DAILY_TABLE_NAME} LIMIT 1")).first() is None:
+                self._rebuild_daily_rollup(conn, None)
+            # 只在统计信息过期时才重新分析，启动时开销很小
+            conn.execute(text("PRAGMA optimize"))
 
     def store_conversation(self, event_id, messages, lanlan_name, timestamp=None):
         if timestamp is None:
             timestamp = datetime.now()
 
-        origin_history = SQLChatMessageHistory(
-            connection=self.engine[lanlan_name],
-            session_id=event_id,
-            table_name=TIME_ORIGINAL_TABLE_NAME,
-        )
+        # 摘要需要调用模型，先在事务外生成，避免长时间持有写锁
+        summary = SystemMessage(self.recent_history_manager.summarize_event(event_id, messages, lanlan_name)[1])
 
-        compressed_history = SQLChatMessageHistory(
-            connection=self.engine[lanlan_name],
-            session_id=event_id,
-            table_name=TIME_COMPRESSED_TABLE_NAME,
-        )
-
-        origin_history.add_messages(messages)
-        compressed_history.add_message(SystemMessage(self.recent_history_manager.compress_history(messages, lanlan_name)[1]))
+        # 时间戳在插入时一并写入，整段对话一次提交
+        rows = [{"session_id": event_id, "message": json.dumps(message_to_dict(m), ensure_ascii=False), "timestamp": timestamp}
+                for m in messages]
+        with self.engine[lanlan_name].begin() as conn:
+            if rows:
+                conn.execute(_insert_sql(TIME_ORIGINAL_TABLE_NAME), rows)
+            conn.execute(
+                _insert_sql(TIME_COMPRESSED_TABLE_NAME),
+                {"session_id": event_id, "message": json.dumps(message_to_dict(summary), ensure_ascii=False), "timestamp": timestamp}
+            )
+            self._add_to_daily_rollup(conn, timestamp, len(rows), {m.type for m in messages}, summary.content)
 
-        with self.engine[lanlan_name].connect() as conn:
+    def _add_to_daily_rollup(self, conn, timestamp, message_count, participants, summary):
+        # 随每次写入增量更新当天的汇总行
+        day = timestamp.strftime('%Y-%m-%d')
+        row = conn.execute(
+            text(f"SELECT participants FROM {TIME_DAILY_TABLE_NAME} WHERE day = :day"), {"day": day}
+        ).first()
+        if row is None:
             conn.execute(
-                text(f"UPDATE {TIME_ORIGINAL_TABLE_NAME} SET timestamp = :timestamp WHERE session_id = :session_id"),
-                {"timestamp": timestamp, "session_id": event_id}
+                text(f"INSERT INTO {TIME_DAILY_TABLE_NAME} (day, message_count, session_count, participants, summary) "
+                     f"VALUES (:day, :message_count, 1, :participants, :summary)"),
+                {"day": day, "message_count": message_count,
+                 "participants": json.dumps(sorted(participants)), "summary": summary}
             )
+        else:
+            merged = sorted(set(json.loads(row[0])) | participants)
             conn.execute(
-                text(f"UPDATE {TIME_COMPRESSED_TABLE_NAME} SET timestamp = :timestamp WHERE session_id = :session_id"),
-                {"timestamp": timestamp, "session_id": event_id}
+                text(f"UPDATE {TIME_DAILY_TABLE_NAME} SET message_count = message_count + :message_count, "
+                     f"session_count = session_count + 1, participants = :participants, "
+                     f"summary = summary || char(10) || :summary WHERE day = :day"),
+                {"day": day, "message_count": message_count, "participants": json.dumps(merged), "summary": summary}
             )
-            conn.commit()
+
+    def _rebuild_daily_rollup(self, conn, days):
+        """从原始表与摘要表重算指定日期（None 表示全部）的汇总行。"""
+        day_filter = ""
+        params = {}
+        if days is not None:
+            days = set(days)
+            if not days:
+                return
+            # 用时间范围而不是 substr(...) IN (...)，这样能走 timestamp 索引
+            lo = min(days)
+            hi = (datetime.strptime(max(days), '%Y-%m-%d') + timedelta(days=1)).strftime('%Y-%m-%d')
+            day_filter = "WHERE timestamp >= :lo AND timestamp < :hi"
+            params = {"lo": lo, "hi": hi}
+            conn.execute(text(f"DELETE FROM {TIME_DAILY_TABLE_NAME} WHERE day = :day"), [{"day": d} for d in days])
+        else:
+            conn.execute(text(f"DELETE FROM {TIME_DAILY_TABLE_NAME}"))
+        rollup = {}
+        for day, session_id, message in conn.execute(
+                text(f"SELECT substr(timestamp, 1, 10), session_id, message FROM {TIME_ORIGINAL_TABLE_NAME} "
+                     f"{day_filter} ORDER BY timestamp, id"), params):
+            if day is None or (days is not None and day not in days):
+                continue
+            entry = rollup.setdefault(day, {"messages": 0, "sessions": set(), "participants": set(), "summaries": []})
+            entry["messages"] += 1
+            entry["sessions"].add(session_id)
+            entry["participants"].add(json.loads(message).get("type"))
+        for day, message in conn.execute(
+                text(f"SELECT substr(timestamp, 1, 10), message FROM {TIME_COMPRESSED_TABLE_NAME} "
+                     f"{day_filter} ORDER BY timestamp, id"), params):
+            if day in rollup:
+                rollup[day]["summaries"].append(json.loads(message).get("data", {}).get("content", ""))
+        if rollup:
+            conn.execute(
+                text(f"INSERT INTO {TIME_DAILY_TABLE_NAME} (day, message_count, session_count, participants, summary) "
+                     f"VALUES (:day, :message_count, :session_count, :participants, :summary)"),
+                [{"day": day, "message_count": e["messages"], "session_count": len(e["sessions"]),
+                  "participants": json.dumps(sorted(p for p in e["participants"] if p)),
+                  "summary": "\n".join(e["summaries"])}
+                 for day, e in rollup.items()]
+            )
+
+    def bulk_store_original(self, lanlan_name, conversations, batch_size=2000, checkpoint_path=None, progress=None):
+        """
+        批量写入原始消息（用于从归档重建时间索引，不生成摘要）。
+        - conversations: 可迭代的 (event_id, message_dicts, timestamp)，message_dicts 为 messages_to_dict 格式
+        - 每批在一个事务内先删除同 event_id 的旧行再插入，重复执行是幂等的
+        - checkpoint_path / progress 的含义同 SemanticMemoryOriginal.bulk_ingest
+        返回本次写入的 (对话数, 消息数)。
+        """
+        done = set()
+        if checkpoint_path and os.path.exists(checkpoint_path):
+            with open(checkpoint_path, 'r', encoding='utf-8') as f:
+                done = {line.strip() for line in f if line.strip()}
+        rows, events = [], []
+        n_conversations = n_messages = 0
+
+        def _flush():
+            nonlocal n_conversations, n_messages
+            if not events:
+                return
+            with self.engine[lanlan_name].begin() as conn:
+                # 被替换的旧行所在日期也需要重算
+                affected = {r[0] for e in events for r in conn.execute(
+                    text(f"SELECT DISTINCT substr(timestamp, 1, 10) FROM {TIME_ORIGINAL_TABLE_NAME} WHERE session_id = :session_id"),
+                    {"session_id": e}) if r[0]}
+                conn.execute(
+                    text(f"DELETE FROM {TIME_ORIGINAL_TABLE_NAME} WHERE session_id = :session_id"),
+                    [{"session_id": e} for e in events]
+                )
+                if rows:
+                    conn.execute(_insert_sql(TIME_ORIGINAL_TABLE_NAME), rows)
+                # 批量写入会替换整段对话，直接重算受影响日期的汇总，保证重复执行时计数不翻倍
+                affected |= {r["timestamp"].strftime('%Y-%m-%d') for r in rows if r["timestamp"]}
+                self._rebuild_daily_rollup(conn, affected)
+            if checkpoint_path:
+                with open(checkpoint_path, 'a', encoding='utf-8') as f:
+                    f.write("".join(f"{e}\n" for e in events))
+            n_conversations += len(events)
+            n_messages += len(rows)
+            rows.clear()
+            events.clear()
+            if progress:
+                progress(n_conversations, n_messages)
+
+        for event_id, message_dicts, timestamp in conversations:
+            if event_id in done:
+                continue
+            events.append(event_id)
+            for m in message_dicts:
+                rows.append({"session_id": event_id, "message": json.dumps(m, ensure_ascii=False), "timestamp": timestamp})
+            if len(rows) >= batch_size:
+                _flush()
+        _flush()
+        return n_conversations, n_messages
+
+    def retrieve_page(self, lanlan_name, start_time, end_time, compressed=False, limit=200, cursor=None):
+        """
+        按 (timestamp, id) 键集分页读取时间范围内的记录，每页只扫描 limit 行。
+        - cursor: 上一页返回的 next_cursor，首页传 None
+        返回 (rows, next_cursor)，rows 为 (id, session_id, message, timestamp)；没有更多数据时 next_cursor 为 None。
+        """
+        table = TIME_COMPRESSED_TABLE_NAME if compressed else TIME_ORIGINAL_TABLE_NAME
+        params = {"start_time": start_time, "end_time": end_time, "limit": limit}
+        keyset = ""
+        if cursor:
+            last_ts, last_id = cursor.rsplit("|", 1)
+            keyset = "AND (timestamp, id) > (:last_ts, :last_id)"
+            params.update(last_ts=last_ts, last_id=int(last_id))
+        with self.engine[lanlan_name].connect() as conn:
+            rows = conn.execute(
+                text(f"SELECT id, session_id, message, timestamp FROM {table} "
+                     f"WHERE timestamp BETWEEN :start_time AND :end_time {keyset} "
+                     f"ORDER BY timestamp, id LIMIT :limit"),
+                params
+            ).fetchall()
+        next_cursor = f"{rows[-1][3]}|{rows[-1][0]}" if len(rows) == limit else None
+        return rows, next_cursor
+
+    def iter_by_timeframe(self, lanlan_name, start_time, end_time, compressed=False, page_size=500):
+        """逐条产出时间范围内的 (session_id, message)，内部按页读取，不会一次性载入整个窗口。"""
+        cursor = None
+        while True:
+            rows, cursor = self.retrieve_page(lanlan_name, start_time, end_time, compressed, page_size, cursor)
+            for row in rows:
+                yield row[1], row[2]
+            if cursor is None:
+                return
+
+    def retrieve_daily_rollup(self, lanlan_name, start_date, end_date):
+        """按天返回汇总：[{day, message_count, session_count, participants, summary}]，日期含两端。"""
+        with self.engine[lanlan_name].connect() as conn:
+            rows = conn.execute(
+                text(f"SELECT day, message_count, session_count, participants, summary FROM {TIME_DAILY_TABLE_NAME} "
+                     f"WHERE day BETWEEN :start_day AND :end_day ORDER BY day"),
+                {"start_day": _day_str(start_date), "end_day": _day_str(end_date)}
+            ).fetchall()
+        return [
+            {"day": r[0], "message_count": r[1], "session_count": r[2], "participants": json.loads(r[3]), "summary": r[4]}
+            for r in rows
+        ]
+
+    def recall_by_timeframe(self, lanlan_name, start_time, end_time, detail_days=2):
+        """
+        时间范围回忆：跨度不超过 detail_days 天时逐条返回该范围内的会话摘要，
+        更宽的范围直接用日汇总作答（按整天计），开销只与天数有关。
+        返回 ("detail", [(session_id, message), ...]) 或 ("daily", retrieve_daily_rollup 的结果)。
+        """
+        if end_time - start_time <= timedelta(days=detail_days):
+            return "detail", list(self.iter_by_timeframe(lanlan_name, start_time, end_time, compressed=True))
+        return "daily", self.retrieve_daily_rollup(lanlan_name, start_time, end_time)
 
     def retrieve_summary_by_timeframe(self, lanlan_name, start_time, end_time):
         with self.engine[lanlan_name].connect() as conn:
@@ -3,19 +3,23 @@ import sys, os
 sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
 from memory import CompressedRecentHistoryManager, SemanticMemory, ImportantSettingsManager, TimeIndexedMemory
 from fastapi import FastAPI, BackgroundTasks
+from fastapi.responses import StreamingResponse
 import json
 import uvicorn
 from langchain_core.messages import convert_to_messages, messages_to_dict, HumanMessage, AIMessage, SystemMessage
 from uuid import uuid4
 from config import get_character_data, MEMORY_SERVER_PORT
+from config.core_config import core_config
 from pydantic import BaseModel
 import re
 import asyncio
 import logging
 import argparse
-from datetime import datetime
+from datetime import datetime, time as dt_time
 import glob
 import gzip
+from concurrent.futures import ThreadPoolExecutor
+import threading
 
 # Setup logger
 logger = logging.getLogger(__name__)
@@ -48,7 +52,21 @@ batch_queue: asyncio.Queue | None = None
 consumer_task: asyncio.Task | None = None
 BATCH_MAX = 8
 BATCH_TIMEOUT_SEC = 0.5
+# 记忆写入工作线程数：不同角色并行处理，同一角色严格按入队顺序串行处理
+MEMORY_WORKERS = 4
+memory_executor: ThreadPoolExecutor | None = None
+# 每个角色队列的容量：队列满时分发协程会等待，batch_queue 随之填满，/process 与 /renew 入队失败并返回错误
+EE_QUEUE_MAX = 64
+ee_queues: dict[str, asyncio.Queue] = {}
+ee_workers: dict[str, asyncio.Task] = {}
+# 每个角色的归档锁：worker 线程写会话归档/追加日志与压缩合并+删除分片互斥，避免合并后写入的分片被误删
+archive_locks: dict[str, threading.RLock] = {}
+archive_locks_guard = threading.Lock()
 compact_task: asyncio.Task | None = None
+settings_flush_task: asyncio.Task | None = None
+SETTINGS_FLUSH_CHECK_SEC = 60
+SETTINGS_SHUTDOWN_FLUSH_SEC = 30
+RECENT_SUMMARY_SHUTDOWN_WAIT_SEC = 30
 COMPACT_ENABLED = True
 COMPACT_LINES = 2000
 COMPACT_SIZE_MB = 64
@@ -71,6 +89,67 @@ def _daily_append_path(ee_name: str, date: str):
     _ensure_dir(base_dir)
     return os.path.join(base_dir, f"append_{ee_name}_{date}.ndjson.gz")
 
+def _archive_lock(ee_name: str) -> threading.RLock:
+    with archive_locks_guard:
+        lock = archive_locks.get(ee_name)
+        if lock is None:
+            lock = archive_locks[ee_name] = threading.RLock()
+        return lock
+
+def _process_item(b):
+    """在工作线程中处理一条 process/renew 记录（包含阻塞的 LLM 调用与磁盘写入）。"""
+    uid = b.get("uid")
+    ee = b.get("ee_name")
+    msgs = b.get("messages")
+    t = b.get("type")
+    if t == "renew":
+        recent_history_manager.update_history(msgs, ee, detailed=True)
+        semantic_manager.store_conversation(uid, msgs, ee)
+        time_manager.store_conversation(uid, msgs, ee)
+        settings_manager.submit_conversation(msgs, ee)
+    else:
+        recent_history_manager.update_history(msgs, ee)
+        semantic_manager.store_conversation(uid, msgs, ee)
+        time_manager.store_conversation(uid, msgs, ee)
+        settings_manager.submit_conversation(msgs, ee)
+        try:
+            with _archive_lock(ee):
+                base_dir = os.path.join(os.path.dirname(__file__), 'memory', 'store', 'archive', ee)
+                os.makedirs(base_dir, exist_ok=True)
+                ts = datetime.now().strftime('%Y%m%d_%H%M%S')
+                archive_file = os.path.join(base_dir, f"session_{ts}_{uid}.json.gz")
+                with gzip.open(archive_file, 'wt', encoding='utf-8') as gf:
+                    json.dump(messages_to_dict(msgs), gf, ensure_ascii=False)
+                day = datetime.now().strftime('%Y%m%d')
+                append_path = _daily_append_path(ee, day)
+                _append_ndjson_gz(append_path, {
+                    "uid": uid,
+                    "timestamp": datetime.now().isoformat(),
+                    "messages": messages_to_dict(msgs)
+                })
+        except Exception:
+            pass
+
+async def _ee_worker(ee_name: str, queue: asyncio.Queue):
+    loop = asyncio.get_running_loop()
+    while True:
+        item = await queue.get()
+        try:
+            await loop.run_in_executor(memory_executor, _process_item, item)
+        except Exception as e:
+            logger.error(f"处理 {ee_name} 的记忆写入失败: {e}")
+        finally:
+            queue.task_done()
+
+async def _dispatch_item(item):
+    """按角色分发到各自的有序队列，首次出现的角色会启动专属的 worker 协程；队列满时等待，把背压传回 batch_queue。"""
+    ee = item.get("ee_name")
+    queue = ee_queues.get(ee)
+    if queue is None:
+        queue = ee_queues[ee] = asyncio.Queue(maxsize=EE_QUEUE_MAX)
+        ee_workers[ee] = asyncio.create_task(_ee_worker(ee, queue))
+    await queue.put(item)
+
 @app.post("/shutdown")
 async def shutdown_memory_server():
     """接收来自main_server的关闭信号"""
@@ -134,6 +213,43 @@ def process_conversation(request: HistoryRequest, ee_name: str, background_tasks
     except Exception as e:
         return {"status": "error", "message": str(e)}
 
+class _JsonArrayWriter:
+    """把元素逐个写成一个 JSON 数组，输出与 json.dump(list, indent=...) 相同。"""
+
+    def __init__(self, f, indent=None):
+        self.f = f
+        self.indent = indent
+        self.count = 0
+
+    def write(self, obj):
+        if self.indent is None:
+            self.f.write(("[" if self.count == 0 else ", ") + json.dumps(obj, ensure_ascii=False))
+        else:
+            pad = " " * self.indent
+            body = json.dumps(obj, ensure_ascii=False, indent=self.indent).replace("\n", "\n" + pad)
+            self.f.write(("[\n" if self.count == 0 else ",\n") + pad + body)
+        self.count += 1
+
+    def close(self):
+        if self.count == 0:
+            self.f.write("[]")
+        else:
+            self.f.write("]" if self.indent is None else "\n]")
+
+def _session_separator(tag: str):
+    return {
+        "type": "system",
+        "data": {
+            "content": f"会话分割: {tag}",
+            "additional_kwargs": {},
+            "response_metadata": {},
+            "type": "system",
+            "name": None,
+            "id": None,
+            "example": False
+        }
+    }
+
 @app.post("/archive/merge_by_day/{ee_name}")
 def merge_archive_by_day(ee_name: str, date: str, compress: bool = True):
     """
@@ -141,6 +257,10 @@ def merge_archive_by_day(ee_name: str, date: str, compress: bool = True):
     - 输入：ee_name 角色名，date 形如 '20251115'，compress 是否生成 .gz 压缩文件
     - 输出文件：memory/store/archive/<ee_name>/day/merged_<ee_name>_<date>.json(.gz)
     """
+    with _archive_lock(ee_name):
+        return _merge_archive_by_day(ee_name, date, compress)
+
+def _merge_archive_by_day(ee_name: str, date: str, compress: bool):
     try:
         base_dir = os.path.join(os.path.dirname(__file__), 'memory', 'store', 'archive', ee_name)
         day_dir = os.path.join(base_dir, 'day')
@@ -151,75 +271,53 @@ def merge_archive_by_day(ee_name: str, date: str, compress: bool = True):
         if not files:
             return {"success": False, "error": f"未找到指定日期 {date} 的会话归档"}
 
-        merged_messages = []
+        out_base = os.path.join(day_dir, f"merged_{ee_name}_{date}.json")
+        out_path = out_base + ".gz" if compress else out_base
+        tmp_path = out_path + ".tmp"
         merged_count = 0
-        for fp in files:
-            try:
-                if fp.endswith('.gz'):
-                    with gzip.open(fp, 'rt', encoding='utf-8') as f:
-                        msgs = json.load(f)
-                else:
-                    with open(fp, 'r', encoding='utf-8') as f:
-                        msgs = json.load(f)
-                # 会话分隔标记（系统消息），便于后续检索
-                merged_messages.append({
-                    "type": "system",
-                    "data": {
-                        "content": f"会话分割: {os.path.basename(fp)}",
-                        "additional_kwargs": {},
-                        "response_metadata": {},
-                        "type": "system",
-                        "name": None,
-                        "id": None,
-                        "example": False
-                    }
-                })
-                # 拼接当前会话的消息列表
-                if isinstance(msgs, list):
-                    merged_messages.extend(msgs)
-                merged_count += 1
-            except Exception as e:
-                logging.warning(f"合并文件失败 {fp}: {e}")
-
-        try:
-            append_fp = _daily_append_path(ee_name, date)
-            if os.path.exists(append_fp):
-                with gzip.open(append_fp, 'rt', encoding='utf-8') as gf:
-                    for line in gf:
-                        try:
-                            rec = json.loads(line.strip())
-                            merged_messages.append({
-                                "type": "system",
-                                "data": {
-                                    "content": f"会话分割: append_line_{rec.get('uid','')}",
-                                    "additional_kwargs": {},
-                                    "response_metadata": {},
-                                    "type": "system",
-                                    "name": None,
-                                    "id": None,
-                                    "example": False
-                                }
-                            })
-                            if isinstance(rec.get("messages"), list):
-                                merged_messages.extend(rec["messages"])
-                            merged_count += 1
-                        except Exception:
-                            pass
-        except Exception:
-            pass
+        # 逐个读取输入、逐条写出数组元素，内存占用只与单个会话大小有关
+        with (gzip.open(tmp_path, 'wt', encoding='utf-8') if compress else open(tmp_path, 'w', encoding='utf-8')) as out:
+            writer = _JsonArrayWriter(out, indent=None if compress else 2)
+            for fp in files:
+                try:
+                    if fp.endswith('.gz'):
+                        with gzip.open(fp, 'rt', encoding='utf-8') as f:
+                            msgs = json.load(f)
+                    else:
+                        with open(fp, 'r', encoding='utf-8') as f:
+                            msgs = json.load(f)
+                    # 会话分隔标记（系统消息），便于后续检索
+                    writer.write(_session_separator(os.path.basename(fp)))
+                    # 拼接当前会话的消息列表
+                    if isinstance(msgs, list):
+                        for m in msgs:
+                            writer.write(m)
+                    merged_count += 1
+                except Exception as e:
+                    logging.warning(f"合并文件失败 {fp}: {e}")
 
-        out_base = os.path.join(day_dir, f"merged_{ee_name}_{date}.json")
-        if compress:
-            out_path = out_base + ".gz"
-            with gzip.open(out_path, 'wt', encoding='utf-8') as gf:
-                json.dump(merged_messages, gf, ensure_ascii=False)
-        else:
-            out_path = out_base
-            with open(out_path, 'w', encoding='utf-8') as f:
-                json.dump(merged_messages, f, ensure_ascii=False, indent=2)
+            try:
+                append_fp = _daily_append_path(ee_name, date)
+                if os.path.exists(append_fp):
+                    with gzip.open(append_fp, 'rt', encoding='utf-8') as gf:
+                        for line in gf:
+                            try:
+                                rec = json.loads(line.strip())
+                                writer.write(_session_separator(f"append_line_{rec.get('uid','')}"))
+                                if isinstance(rec.get("messages"), list):
+                                    for m in rec["messages"]:
+                                        writer.write(m)
+                                merged_count += 1
+                            except Exception:
+                                pass
+            except Exception:
+                pass
+            writer.close()
+        # 写完整个文件后再替换，中途失败不会留下半个合并文件
+        os.replace(tmp_path, out_path)
 
-        logger.info(f"已生成合并归档: {out_path}，合并会话数: {merged_count}，消息总数: {len(merged_messages)}")
-        return {"success": True, "output": out_path, "sessions": merged_count, "messages": len(merged_messages)}
+        logger.info(f"已生成合并归档: {out_path}，合并会话数: {merged_count}，消息总数: {writer.count}")
+        return {"success": True, "output": out_path, "sessions": merged_count, "messages": writer.count}
     except Exception as e:
         import traceback
         traceback.print_exc()
@@ -266,7 +364,7 @@ def process_conversation_for_renew(request: HistoryRequest, ee_name: str, backgr
 
 @app.get("/get_recent_history/{ee_name}")
 def get_recent_history(ee_name: str):
-    history = recent_history_manager.get_recent_history(ee_name)
+    history = recent_history_manager.get_recent_window(ee_name)
     _, _, _, _, name_mapping, _, _, _, _, _ = get_character_data()
     name_mapping['ai'] = ee_name
     result = f"开始聊天前，{ee_name}又在脑海内整理了近期发生的事情。\n"
@@ -286,6 +384,54 @@ def get_memory(query: str, ee_name:str):
     except Exception as e:
         return f"semantic_error: {e}"
 
+def _parse_time_bound(value: str, end: bool = False):
+    # 只给日期时，结束边界取当天最后一刻
+    t = datetime.fromisoformat(value)
+    if end and len(value) == 10:
+        t = datetime.combine(t.date(), dt_time.max)
+    return t
+
+def _time_row_to_dict(session_id, message, timestamp=None, row_id=None):
+    item = {"session_id": session_id, "message": json.loads(message)}
+    if timestamp is not None:
+        item["timestamp"] = str(timestamp)
+    if row_id is not None:
+        item["id"] = row_id
+    return item
+
+@app.get("/time_memory/{ee_name}")
+def get_time_memory_page(ee_name: str, start: str, end: str, compressed: bool = False, limit: int = 200, cursor: str | None = None):
+    """按时间范围分页读取记忆，翻页时把返回的 next_cursor 原样传回。"""
+    try:
+        rows, next_cursor = time_manager.retrieve_page(
+            ee_name, _parse_time_bound(start), _parse_time_bound(end, end=True),
+            compressed=compressed, limit=max(1, min(limit, 1000)), cursor=cursor)
+        return {
+            "items": [_time_row_to_dict(r[1], r[2], r[3], r[0]) for r in rows],
+            "next_cursor": next_cursor,
+        }
+    except Exception as e:
+        return {"success": False, "error": str(e)}
+
+@app.get("/time_memory/{ee_name}/stream")
+def stream_time_memory(ee_name: str, start: str, end: str, compressed: bool = False):
+    """以 NDJSON 流式返回整个时间范围内的记忆，每行一条记录。"""
+    if ee_name not in time_manager.engine:
+        return {"success": False, "error": f"未知角色: {ee_name}"}
+    rows = time_manager.iter_by_timeframe(
+        ee_name, _parse_time_bound(start), _parse_time_bound(end, end=True), compressed=compressed)
+    return StreamingResponse(
+        (json.dumps(_time_row_to_dict(sid, msg), ensure_ascii=False) + "\n" for sid, msg in rows),
+        media_type="application/x-ndjson")
+
+@app.get("/time_memory/{ee_name}/daily")
+def get_time_memory_daily(ee_name: str, start: str, end: str):
+    """按天返回时间范围内的汇总（消息数、会话数、参与者、当天摘要）。"""
+    try:
+        return {"days": time_manager.retrieve_daily_rollup(ee_name, _parse_time_bound(start), _parse_time_bound(end, end=True))}
+    except Exception as e:
+        return {"success": False, "error": str(e)}
+
 @app.get("/get_settings/{ee_name}")
 def get_settings(ee_name: str):
     result = f"{ee_name}记得{json.dumps(settings_manager.get_settings(ee_name), ensure_ascii=False)}"
@@ -299,7 +445,7 @@ def new_dialog(ee_name: str):
     name_mapping['ai'] = ee_name
     result = f"\n========{ee_name}的内心活动========\n{ee_name}的脑海里经常想着自己和{master_name}的事情，她记得{json.dumps(settings_manager.get_settings(ee_name), ensure_ascii=False)}\n\n"
     result += f"开始聊天前，{ee_name}又在脑海内整理了近期发生的事情。\n"
-    for i in recent_history_manager.get_recent_history(ee_name):
+    for i in recent_history_manager.get_recent_window(ee_name):
         if isinstance(i.content, str):
             clean_text = m1.sub('', i.content)
             result += f"{name_mapping[i.type]} | {clean_text}\n"
@@ -342,24 +488,16 @@ def set_compact_config(cfg: CompactConfig):
         if cfg.archive_compact_window_end_hour is not None:
             COMPACT_WINDOW_END_HOUR = int(cfg.archive_compact_window_end_hour)
 
-        cfg_path = os.path.join(os.path.dirname(__file__), 'config', 'core_config.json')
-        data = {}
         try:
-            if os.path.exists(cfg_path):
-                with open(cfg_path, 'r', encoding='utf-8') as f:
-                    data = json.load(f)
-        except Exception:
-            data = {}
-        data['archive_compact_enabled'] = COMPACT_ENABLED
-        data['archive_compact_lines_threshold'] = COMPACT_LINES
-        data['archive_compact_size_mb_threshold'] = COMPACT_SIZE_MB
-        data['archive_compact_interval_sec'] = COMPACT_INTERVAL_SEC
-        data['archive_compact_delete_shards'] = COMPACT_DELETE_SHARDS
-        data['archive_compact_window_start_hour'] = COMPACT_WINDOW_START_HOUR
-        data['archive_compact_window_end_hour'] = COMPACT_WINDOW_END_HOUR
-        try:
-            with open(cfg_path, 'w', encoding='utf-8') as f:
-                json.dump(data, f, ensure_ascii=False, indent=2)
+            core_config.update({
+                'archive_compact_enabled': COMPACT_ENABLED,
+                'archive_compact_lines_threshold': COMPACT_LINES,
+                'archive_compact_size_mb_threshold': COMPACT_SIZE_MB,
+                'archive_compact_interval_sec': COMPACT_INTERVAL_SEC,
+                'archive_compact_delete_shards': COMPACT_DELETE_SHARDS,
+                'archive_compact_window_start_hour': COMPACT_WINDOW_START_HOUR,
+                'archive_compact_window_end_hour': COMPACT_WINDOW_END_HOUR,
+            })
         except Exception:
             pass
         return {'success': True}
@@ -370,23 +508,18 @@ def set_compact_config(cfg: CompactConfig):
 
 @app.on_event("startup")
 async def on_startup():
-    global batch_queue, consumer_task, compact_task
+    global batch_queue, consumer_task, compact_task, settings_flush_task, memory_executor, MEMORY_WORKERS
     global COMPACT_ENABLED, COMPACT_LINES, COMPACT_SIZE_MB, COMPACT_INTERVAL_SEC, COMPACT_DELETE_SHARDS, COMPACT_WINDOW_START_HOUR, COMPACT_WINDOW_END_HOUR
     batch_queue = asyncio.Queue(maxsize=1000)
-    try:
-        cfg_path = os.path.join(os.path.dirname(__file__), 'config', 'core_config.json')
-        if os.path.exists(cfg_path):
-            with open(cfg_path, 'r', encoding='utf-8') as f:
-                cfg = json.load(f)
-            COMPACT_ENABLED = bool(cfg.get('archive_compact_enabled', COMPACT_ENABLED))
-            COMPACT_LINES = int(cfg.get('archive_compact_lines_threshold', COMPACT_LINES))
-            COMPACT_SIZE_MB = int(cfg.get('archive_compact_size_mb_threshold', COMPACT_SIZE_MB))
-            COMPACT_INTERVAL_SEC = int(cfg.get('archive_compact_interval_sec', COMPACT_INTERVAL_SEC))
-            COMPACT_DELETE_SHARDS = bool(cfg.get('archive_compact_delete_shards', COMPACT_DELETE_SHARDS))
-            COMPACT_WINDOW_START_HOUR = int(cfg.get('archive_compact_window_start_hour', COMPACT_WINDOW_START_HOUR))
-            COMPACT_WINDOW_END_HOUR = int(cfg.get('archive_compact_window_end_hour', COMPACT_WINDOW_END_HOUR))
-    except Exception:
-        pass
+    COMPACT_ENABLED = core_config.get_bool('archive_compact_enabled', COMPACT_ENABLED)
+    COMPACT_LINES = core_config.get_int('archive_compact_lines_threshold', COMPACT_LINES)
+    COMPACT_SIZE_MB = core_config.get_int('archive_compact_size_mb_threshold', COMPACT_SIZE_MB)
+    COMPACT_INTERVAL_SEC = core_config.get_int('archive_compact_interval_sec', COMPACT_INTERVAL_SEC)
+    COMPACT_DELETE_SHARDS = core_config.get_bool('archive_compact_delete_shards', COMPACT_DELETE_SHARDS)
+    COMPACT_WINDOW_START_HOUR = core_config.get_int('archive_compact_window_start_hour', COMPACT_WINDOW_START_HOUR)
+    COMPACT_WINDOW_END_HOUR = core_config.get_int('archive_compact_window_end_hour', COMPACT_WINDOW_END_HOUR)
+    MEMORY_WORKERS = max(1, core_config.get_int('memory_worker_count', MEMORY_WORKERS))
+    memory_executor = ThreadPoolExecutor(max_workers=MEMORY_WORKERS, thread_name_prefix="memory-worker")
     async def _consume():
         loop = asyncio.get_running_loop()
         while True:
@@ -403,34 +536,7 @@ async def on_startup():
                 except asyncio.TimeoutError:
                     break
             for b in batch:
-                uid = b.get("uid")
-                ee = b.get("ee_name")
-                msgs = b.get("messages")
-                t = b.get("type")
-                if t == "renew":
-                    recent_history_manager.update_history(msgs, ee, detailed=True)
-                    semantic_manager.store_conversation(uid, msgs, ee)
-                    time_manager.store_conversation(uid, msgs, ee)
-                else:
-                    recent_history_manager.update_history(msgs, ee)
-                    semantic_manager.store_conversation(uid, msgs, ee)
-                    time_manager.store_conversation(uid, msgs, ee)
-                    try:
-                        base_dir = os.path.join(os.path.dirname(__file__), 'memory', 'store', 'archive', ee)
-                        os.makedirs(base_dir, exist_ok=True)
-                        ts = datetime.now().strftime('%Y%m%d_%H%M%S')
-                        archive_file = os.path.join(base_dir, f"session_{ts}_{uid}.json.gz")
-                        with gzip.open(archive_file, 'wt', encoding='utf-8') as gf:
-                            json.dump(messages_to_dict(msgs), gf, ensure_ascii=False)
-                        day = datetime.now().strftime('%Y%m%d')
-                        append_path = _daily_append_path(ee, day)
-                        _append_ndjson_gz(append_path, {
-                            "uid": uid,
-                            "timestamp": datetime.now().isoformat(),
-                            "messages": messages_to_dict(msgs)
-                        })
-                    except Exception:
-                        pass
+                await _dispatch_item(b)
     consumer_task = asyncio.create_task(_consume())
     async def _auto_compact():
         def _append_path(ee: str, d: str):
@@ -451,6 +557,25 @@ async def on_startup():
                 return os.path.getsize(fp) / 1_000_000.0
             except Exception:
                 return 0.0
+        def _compact_day(ee: str, d: str, ap: str):
+            with _archive_lock(ee):
+                res = merge_archive_by_day(ee, d, compress=True)
+                if isinstance(res, dict) and res.get('success') and COMPACT_DELETE_SHARDS:
+                    base_dir = os.path.join(os.path.dirname(__file__), 'memory', 'store', 'archive', ee)
+                    for fp in glob.glob(os.path.join(base_dir, f"session_{d}_*.json")):
+                        try:
+                            os.remove(fp)
+                        except Exception:
+                            pass
+                    for fp in glob.glob(os.path.join(base_dir, f"session_{d}_*.json.gz")):
+                        try:
+                            os.remove(fp)
+                        except Exception:
+                            pass
+                    try:
+                        os.remove(ap)
+                    except Exception:
+                        pass
         def _within_window() -> bool:
             h = datetime.now().hour
             if COMPACT_WINDOW_START_HOUR <= COMPACT_WINDOW_END_HOUR:
@@ -472,23 +597,8 @@ async def on_startup():
                                 ln = _count_lines(ap)
                                 sz = _size_mb(ap)
                                 if ln >= COMPACT_LINES or sz >= COMPACT_SIZE_MB:
-                                    res = merge_archive_by_day(ee, d, compress=True)
-                                    if isinstance(res, dict) and res.get('success') and COMPACT_DELETE_SHARDS:
-                                        base_dir = os.path.join(archive_root, ee)
-                                        for fp in glob.glob(os.path.join(base_dir, f"session_{d}_*.json")):
-                                            try:
-                                                os.remove(fp)
-                                            except Exception:
-                                                pass
-                                        for fp in glob.glob(os.path.join(base_dir, f"session_{d}_*.json.gz")):
-                                            try:
-                                                os.remove(fp)
-                                            except Exception:
-                                                pass
-                                        try:
-                                            os.remove(ap)
-                                        except Exception:
-                                            pass
+                                    # 合并与删除分片在线程中完成，并持有该角色的归档锁
+                                    await asyncio.get_running_loop().run_in_executor(None, _compact_day, ee, d, ap)
                     except Exception:
                         pass
                 await asyncio.sleep(COMPACT_INTERVAL_SEC)
@@ -498,20 +608,60 @@ async def on_startup():
                 logger.error(f"Archive compact error: {e}")
                 await asyncio.sleep(COMPACT_INTERVAL_SEC)
     compact_task = asyncio.create_task(_auto_compact())
+    async def _settings_flush():
+        # 定期检查设定提取批次的时间阈值，角色不再说话时也能处理最后一批
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                await asyncio.sleep(SETTINGS_FLUSH_CHECK_SEC)
+                if settings_manager.extraction_enabled():
+                    await loop.run_in_executor(None, settings_manager.flush_due)
+            except asyncio.CancelledError:
+                break
+            except Exception as e:
+                logger.error(f"Settings flush error: {e}")
+    settings_flush_task = asyncio.create_task(_settings_flush())
 
 @app.on_event("shutdown")
 async def on_shutdown():
-    global consumer_task, compact_task
+    global consumer_task, compact_task, settings_flush_task
     try:
         if consumer_task and not consumer_task.done():
             consumer_task.cancel()
     except Exception:
         pass
+    for task in list(ee_workers.values()):
+        try:
+            if not task.done():
+                task.cancel()
+        except Exception:
+            pass
+    try:
+        if memory_executor is not None:
+            memory_executor.shutdown(wait=False)
+    except Exception:
+        pass
+    try:
+        # 先等待进行中的溢出摘要写回历史，再落盘
+        await asyncio.get_running_loop().run_in_executor(
+            None, recent_history_manager.close, RECENT_SUMMARY_SHUTDOWN_WAIT_SEC)
+    except Exception:
+        pass
     try:
         if compact_task and not compact_task.done():
             compact_task.cancel()
     except Exception:
         pass
+    try:
+        if settings_flush_task and not settings_flush_task.done():
+            settings_flush_task.cancel()
+        # 处理尚未提取的设定批次；最多等待 SETTINGS_SHUTDOWN_FLUSH_SEC，避免拖住退出
+        if settings_manager.extraction_enabled():
+            await asyncio.wait_for(
+                asyncio.get_running_loop().run_in_executor(None, settings_manager.flush_pending),
+                timeout=SETTINGS_SHUTDOWN_FLUSH_SEC)
+    except Exception:
+        pass
 
 if __name__ == "__main__":
     import threading
@@ -5,6 +5,11 @@ import sys, os
 sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
 import asyncio
 import json
+import re
+import time
+import hashlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from config import MONITOR_SERVER_PORT
 from fastapi import FastAPI, WebSocket, WebSocketDisconnect, Request
 from fastapi.staticfiles import StaticFiles
@@ -50,11 +55,19 @@ subtitle_clients = set()
 current_subtitle = ""
 should_clear_next = False
 
+# 流式翻译状态：已切分到的位置，以及按顺序排队的分句翻译任务
+_segmented_upto = 0
+_pending_segments: list = []
+
+_JAPANESE_PATTERN = re.compile(r'[\u3040-\u309F\u30A0-\u30FF]')
+# 含有文字（假名、汉字、字母、数字）的片段才值得送去翻译
+_WORD_PATTERN = re.compile(r'\w')
+# 句末标点，用于在流式输出中切出“完整句子”前缀
+_SENTENCE_END_PATTERN = re.compile(r'[。！？!?…\n]')
+
 def is_japanese(text):
-    import re
-    # 检测平假名、片假名、汉字
-    japanese_pattern = re.compile(r'[\u3040-\u309F\u30A0-\u30FF]')
-    return bool(japanese_pattern.search(text))
+    # 检测平假名、片假名
+    return bool(_JAPANESE_PATTERN.search(text))
 
 # 简单的日文到中文翻译（这里需要你集成实际的翻译API）
 if _HAS_GTRANSLATE:
@@ -62,10 +75,15 @@ if _HAS_GTRANSLATE:
 else:
     translate_client = None
 
-async def translate_japanese_to_chinese(text):
-    # 如果未配置翻译客户端，则直接返回原文，保证服务不崩溃
-    if not translate_client:
-        return text
+TRANSLATION_CACHE_MAX = 512
+TRANSLATION_CACHE_TTL_SEC = 3600
+# 翻译缓存：sha1(原文) -> (写入时间, 译文)，按 LRU 顺序淘汰
+_translation_cache: "OrderedDict[str, tuple[float, str]]" = OrderedDict()
+# 同步翻译 SDK 放到独立线程池中执行，避免阻塞监控服务的事件循环
+_translate_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="monitor-translate")
+
+
+def _google_translate(text):
     results = translate_client.translate(
         values=[text],
         target_language="zh-CN",
@@ -74,6 +92,90 @@ async def translate_japanese_to_chinese(text):
     return results[0]['translatedText']
 
 
+def _local_translate(text):
+    """离线替身翻译器：不访问网络，仅给原文加上标记，便于本地联调字幕流程。"""
+    return f"【译】{text}"
+
+
+if os.environ.get("MONITOR_TRANSLATOR", "").lower() == "local":
+    _translator = _local_translate
+elif translate_client:
+    _translator = _google_translate
+else:
+    _translator = None
+
+
+def set_translator(fn):
+    """替换翻译实现（同步函数 text -> text），传入 None 表示不翻译。切换后清空缓存。"""
+    global _translator
+    _translator = fn
+    _translation_cache.clear()
+
+
+def _cache_get(key):
+    item = _translation_cache.get(key)
+    if item is None:
+        return None
+    ts, value = item
+    if time.monotonic() - ts > TRANSLATION_CACHE_TTL_SEC:
+        _translation_cache.pop(key, None)
+        return None
+    _translation_cache.move_to_end(key)
+    return value
+
+
+def _cache_put(key, value):
+    _translation_cache[key] = (time.monotonic(), value)
+    _translation_cache.move_to_end(key)
+    while len(_translation_cache) > TRANSLATION_CACHE_MAX:
+        _translation_cache.popitem(last=False)
+
+
+async def translate_japanese_to_chinese(text):
+    # 如果未配置翻译器，则直接返回原文，保证服务不崩溃。
+    # 是否为日文由调用方按整段回复判断（纯汉字的分句也要翻译），这里只跳过空白/纯标点的分句
+    if not _translator or not text or not _WORD_PATTERN.search(text):
+        return text
+    key = hashlib.sha1(text.encode('utf-8')).hexdigest()
+    cached = _cache_get(key)
+    if cached is not None:
+        return cached
+    loop = asyncio.get_running_loop()
+    try:
+        translated = await loop.run_in_executor(_translate_executor, _translator, text)
+    except Exception as e:
+        print(f"翻译失败: {e}")
+        return text
+    _cache_put(key, translated)
+    return translated
+
+
+def _schedule_complete_sentences(final=False):
+    """把 current_subtitle 中新出现的完整句子提交翻译；final=True 时连同未完结的尾部一起提交。"""
+    global _segmented_upto
+    tail = current_subtitle[_segmented_upto:]
+    if not tail:
+        return
+    if final:
+        cut = len(tail)
+    else:
+        last = None
+        for last in _SENTENCE_END_PATTERN.finditer(tail):
+            pass
+        if last is None:
+            return
+        cut = last.end()
+    segment = tail[:cut]
+    _segmented_upto += cut
+    _pending_segments.append(asyncio.create_task(translate_japanese_to_chinese(segment)))
+
+
+def _reset_translation_state():
+    global _segmented_upto
+    _segmented_upto = 0
+    _pending_segments.clear()
+
+
 @app.websocket("/subtitle_ws")
 async def subtitle_websocket_endpoint(websocket: WebSocket):
     await websocket.accept()
@@ -124,6 +226,7 @@ async def broadcast_subtitle():
 async def clear_subtitle():
     global current_subtitle
     current_subtitle = ""
+    _reset_translation_state()
 
     clients = subtitle_clients.copy()
     for client in clients:
@@ -156,6 +259,9 @@ async def sync_endpoint(websocket: WebSocket, ee_name:str):
                     current_subtitle += subtitle_text
                     if subtitle_text:
                         await broadcast_subtitle()
+                        # 流式阶段就把已完结的句子提前送去翻译
+                        if is_japanese(current_subtitle):
+                            _schedule_complete_sentences()
 
                 elif data.get("type") == "turn end":
                     print('turn end')
@@ -163,7 +269,10 @@ async def sync_endpoint(websocket: WebSocket, ee_name:str):
                     if current_subtitle:
                         # 检查是否为日文，如果是则翻译
                         if is_japanese(current_subtitle):
-                            translated_text = await translate_japanese_to_chinese(current_subtitle)
+                            _schedule_complete_sentences(final=True)
+                            parts = await asyncio.gather(*_pending_segments)
+                            translated_text = "".join(parts)
+                            _reset_translation_state()
                             current_subtitle = translated_text
                             clients = subtitle_clients.copy()
                             for client in clients:
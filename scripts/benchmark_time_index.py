@@ -0,0 +1,82 @@
+import os
+import sys
+import time
+import random
+import argparse
+import tempfile
+from datetime import datetime, timedelta
+
+from sqlalchemy import create_engine, text
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from memory.timeindex import create_time_indexes, _insert_sql
+
+TABLE = "time_indexed_original"
+
+
+def build_db(path, n, days, seed=0):
+    # 与 SQLChatMessageHistory 建表结构一致，再加上 timestamp 列
+    engine = create_engine(f"sqlite:///{path}")
+    rng = random.Random(seed)
+    start = datetime(2024, 1, 1)
+    with engine.begin() as conn:
+        conn.execute(text(f"CREATE TABLE {TABLE} (id INTEGER PRIMARY KEY AUTOINCREMENT, session_id TEXT, message TEXT, timestamp DATETIME)"))
+        rows = []
+        for i in range(n):
+            ts = start + timedelta(seconds=rng.randrange(days * 86400))
+            rows.append({"session_id": f"s{i // 8}", "message": '{"type": "human", "data": {"content": "x"}}', "timestamp": ts})
+            if len(rows) >= 50000:
+                conn.execute(_insert_sql(TABLE), rows)
+                rows = []
+        if rows:
+            conn.execute(_insert_sql(TABLE), rows)
+    return engine, start
+
+
+def bench(engine, start, days, queries, seed=1):
+    rng = random.Random(seed)
+    ranges = []
+    for _ in range(queries):
+        s = start + timedelta(days=rng.randrange(max(1, days - 1)))
+        ranges.append((s, s + timedelta(days=1)))
+    with engine.connect() as conn:
+        t = time.perf_counter()
+        for s, e in ranges:
+            conn.execute(
+                text(f"SELECT session_id, message FROM {TABLE} WHERE timestamp BETWEEN :start_time AND :end_time"),
+                {"start_time": s, "end_time": e}
+            ).fetchall()
+        range_ms = (time.perf_counter() - t) * 1000 / queries
+        t = time.perf_counter()
+        for _ in range(queries):
+            conn.execute(text(f"SELECT COUNT(*) FROM {TABLE} WHERE session_id = :sid"), {"sid": f"s{rng.randrange(1000)}"}).fetchall()
+        session_ms = (time.perf_counter() - t) * 1000 / queries
+    return range_ms, session_ms
+
+
+def main():
+    parser = argparse.ArgumentParser(description='时间索引表有无索引时的查询耗时基准')
+    parser.add_argument('--sizes', default='10000,100000,1000000')
+    parser.add_argument('--days', type=int, default=365, help='数据覆盖的天数')
+    parser.add_argument('--queries', type=int, default=50)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for n in [int(x) for x in args.sizes.split(',')]:
+            print(f"=== rows={n} days={args.days} ===")
+            engine, start = build_db(os.path.join(tmp, f"bench_{n}.db"), n, args.days)
+            r, s = bench(engine, start, args.days, args.queries)
+            print(f"  no index   range={r:.2f} ms/query  session={s:.2f} ms/query")
+            t = time.perf_counter()
+            with engine.begin() as conn:
+                create_time_indexes(conn, TABLE)
+                conn.execute(text("ANALYZE"))
+            print(f"  build      {time.perf_counter() - t:.2f} s")
+            r, s = bench(engine, start, args.days, args.queries)
+            print(f"  indexed    range={r:.2f} ms/query  session={s:.2f} ms/query")
+            engine.dispose()
+
+
+if __name__ == '__main__':
+    main()
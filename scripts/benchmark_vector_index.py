@@ -0,0 +1,71 @@
+import os
+import sys
+import time
+import argparse
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from memory.semantic import _NumpyVectorIndex, _IVFIndex, _HNSWIndex, hnswlib
+
+
+def make_data(n, dim, clusters, seed=0):
+    # 高斯混合数据，比均匀随机向量更接近真实语义嵌入的分布
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((clusters, dim)).astype(np.float32)
+    labels = rng.integers(0, clusters, size=n)
+    data = centers[labels] + 0.35 * rng.standard_normal((n, dim)).astype(np.float32)
+    return data
+
+
+def bench(name, index, queries, truth, k):
+    hits = 0
+    t = time.perf_counter()
+    for q, gt in zip(queries, truth):
+        ids, _ = index.search(q, k)
+        hits += len(set(ids.tolist()) & gt)
+    ms = (time.perf_counter() - t) * 1000 / len(queries)
+    recall = hits / (len(queries) * k)
+    print(f"  {name:<6} recall@{k}={recall:.3f}  latency={ms:.2f} ms/query")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='精确 / 近似向量索引的召回率与延迟基准')
+    parser.add_argument('--sizes', default='10000,100000,1000000')
+    parser.add_argument('--dim', type=int, default=384)
+    parser.add_argument('--queries', type=int, default=100)
+    parser.add_argument('--k', type=int, default=10)
+    args = parser.parse_args()
+
+    for n in [int(x) for x in args.sizes.split(',')]:
+        print(f"=== n={n} dim={args.dim} ===")
+        data = make_data(n, args.dim, clusters=max(16, n // 2000))
+        exact = _NumpyVectorIndex()
+        exact.add(data)
+        rng = np.random.default_rng(1)
+        queries = data[rng.choice(n, size=args.queries, replace=False)]
+        queries = queries + 0.1 * rng.standard_normal(queries.shape).astype(np.float32)
+
+        t = time.perf_counter()
+        truth = [set(exact.search(q, args.k)[0].tolist()) for q in queries]
+        print(f"  exact  latency={(time.perf_counter() - t) * 1000 / args.queries:.2f} ms/query")
+
+        ivf = _IVFIndex(exact)
+        t = time.perf_counter()
+        ivf.build(n)
+        print(f"  ivf    build={time.perf_counter() - t:.1f} s  nlist={len(ivf.centroids)}")
+        bench('ivf', ivf, queries, truth, args.k)
+
+        if hnswlib is not None:
+            hnsw = _HNSWIndex(exact)
+            t = time.perf_counter()
+            hnsw.build(n)
+            print(f"  hnsw   build={time.perf_counter() - t:.1f} s")
+            bench('hnsw', hnsw, queries, truth, args.k)
+        else:
+            print("  hnsw   skipped (hnswlib 未安装)")
+
+
+if __name__ == '__main__':
+    main()
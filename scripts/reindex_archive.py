@@ -0,0 +1,199 @@
+"""
+从归档重建语义记忆 / 时间索引记忆。
+
+读取 memory/store/archive/<角色名>/ 下的：
+- session_<YYYYMMDD>_<HHMMSS>_<uid>.json(.gz)   单次会话归档
+- day/append_<角色名>_<YYYYMMDD>.ndjson.gz       每日追加日志（与会话归档按 uid 去重）
+- day/merged_<角色名>_<YYYYMMDD>.json(.gz)       压缩合并后的每日归档
+
+解压与解析在多进程中并行，写入端按批次批量嵌入/插入，并记录检查点，中断后可续跑。
+写入使用确定性 id，重复执行是幂等的。
+
+旧版本在线写入的语义记忆使用随机 id，与确定性 id 不会合并；更换了维度不同的嵌入模型时，
+已有集合也无法继续写入。这两种情况需加 --reset：先删除并重建 semantic_<角色名>_original
+（无 Chroma 时为兜底向量库目录），同时清除语义检查点，再从归档完整写入。
+时间索引按 session_id 先删后插，无需重置。
+
+用法：
+    python scripts/reindex_archive.py <角色名> [--target semantic|time|all] [--workers N] [--reset]
+"""
+import os
+import re
+import sys
+import glob
+import gzip
+import json
+import time
+import argparse
+from datetime import datetime
+from multiprocessing import Pool
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+
+ARCHIVE_ROOT = os.path.join(ROOT, 'memory', 'store', 'archive')
+_SESSION_RE = re.compile(r'session_(\d{8})_(\d{6})_([^.]+)\.json(?:\.gz)?$')
+_DAY_RE = re.compile(r'_(\d{8})\.(?:ndjson|json)(?:\.gz)?$')
+_SEPARATOR_PREFIX = "会话分割: "
+
+
+def _open_text(path):
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rt', encoding='utf-8')
+    return open(path, 'r', encoding='utf-8')
+
+
+def _file_date(path):
+    name = os.path.basename(path)
+    m = _SESSION_RE.search(name) or _DAY_RE.search(name)
+    return m.group(1) if m else None
+
+
+def _session_meta(name, fallback_date):
+    m = _SESSION_RE.search(name)
+    if m:
+        ts = datetime.strptime(m.group(1) + m.group(2), '%Y%m%d%H%M%S').isoformat()
+        return m.group(3), ts
+    return None, datetime.strptime(fallback_date, '%Y%m%d').isoformat()
+
+
+def parse_archive_file(path):
+    """在工作进程中执行：解析一个归档文件，返回 [(uid, timestamp_iso, message_dicts), ...]。"""
+    name = os.path.basename(path)
+    out = []
+    try:
+        if name.startswith('session_'):
+            uid, ts = _session_meta(name, _file_date(path))
+            with _open_text(path) as f:
+                msgs = json.load(f)
+            if isinstance(msgs, list):
+                out.append((uid or name, ts, msgs))
+        elif name.startswith('append_'):
+            with _open_text(path) as f:
+                for line in f:
+                    try:
+                        rec = json.loads(line)
+                    except Exception:
+                        # 追加日志末尾可能有未写完的行
+                        continue
+                    if isinstance(rec.get('messages'), list):
+                        out.append((rec.get('uid') or f"{name}:{len(out)}", rec.get('timestamp'), rec['messages']))
+        elif name.startswith('merged_'):
+            date = _file_date(path)
+            with _open_text(path) as f:
+                msgs = json.load(f)
+            current = None
+            for m in msgs if isinstance(msgs, list) else []:
+                content = (m.get('data') or {}).get('content') if isinstance(m, dict) else None
+                if m.get('type') == 'system' and isinstance(content, str) and content.startswith(_SEPARATOR_PREFIX):
+                    tag = content[len(_SEPARATOR_PREFIX):]
+                    if tag.startswith('append_line_'):
+                        uid, ts = tag[len('append_line_'):] or None, datetime.strptime(date, '%Y%m%d').isoformat()
+                    else:
+                        uid, ts = _session_meta(tag, date)
+                    current = (uid or f"{name}:{len(out)}", ts, [])
+                    out.append(current)
+                elif current is not None:
+                    current[2].append(m)
+    except Exception as e:
+        print(f"解析归档失败 {path}: {e}", file=sys.stderr)
+    return out
+
+
+def list_archive_files(ee_name, since=None, until=None):
+    base = os.path.join(ARCHIVE_ROOT, ee_name)
+    files = glob.glob(os.path.join(base, 'session_*.json')) + glob.glob(os.path.join(base, 'session_*.json.gz'))
+    files += glob.glob(os.path.join(base, 'day', 'append_*.ndjson.gz'))
+    files += glob.glob(os.path.join(base, 'day', 'merged_*.json')) + glob.glob(os.path.join(base, 'day', 'merged_*.json.gz'))
+    selected = []
+    for fp in files:
+        d = _file_date(fp)
+        if d is None or (since and d < since) or (until and d > until):
+            continue
+        selected.append((d, fp))
+    # 按日期排序，便于检查点按时间推进
+    return [fp for _, fp in sorted(selected)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='从归档重建语义记忆与时间索引记忆')
+    parser.add_argument('ee_name', help='角色名')
+    parser.add_argument('--target', choices=['semantic', 'time', 'all'], default='all')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='解析归档的进程数')
+    parser.add_argument('--batch-size', type=int, default=512, help='每批写入的消息数')
+    parser.add_argument('--chunk', type=int, default=2000, help='每次交给写入端的对话数')
+    parser.add_argument('--since', help='起始日期 YYYYMMDD（含）')
+    parser.add_argument('--until', help='结束日期 YYYYMMDD（含）')
+    parser.add_argument('--reset-checkpoint', action='store_true', help='忽略并清除已有检查点，从头重建')
+    parser.add_argument('--reset', action='store_true', help='写入前删除并重建该角色的原始语义记忆集合（同时清除语义检查点）')
+    args = parser.parse_args()
+
+    # 重依赖只在主进程中导入，避免每个解析进程都加载嵌入模型
+    from langchain_core.messages import messages_from_dict
+    from config import get_character_data
+    from memory.semantic import SemanticMemoryOriginal
+    from memory.timeindex import TimeIndexedMemory
+
+    _, _, _, _, name_mapping, _, semantic_store, _, _, _ = get_character_data()
+    if args.ee_name not in semantic_store:
+        print(f"未知角色: {args.ee_name}")
+        return 1
+
+    store_dir = os.path.join(ROOT, 'memory', 'store')
+    ckpt = {t: os.path.join(store_dir, f"reindex_{args.ee_name}_{t}.ckpt") for t in ('semantic', 'time')}
+    reset_targets = list(ckpt) if args.reset_checkpoint else ['semantic'] if args.reset else []
+    for t in reset_targets:
+        if os.path.exists(ckpt[t]):
+            os.remove(ckpt[t])
+
+    semantic = None
+    if args.target in ('semantic', 'all'):
+        if args.reset:
+            print(f"删除并重建 semantic_{args.ee_name}_original")
+        semantic = SemanticMemoryOriginal(semantic_store, args.ee_name, name_mapping, reset=args.reset)
+    time_memory = TimeIndexedMemory(None) if args.target in ('time', 'all') else None
+
+    files = list_archive_files(args.ee_name, args.since, args.until)
+    print(f"待处理归档文件: {len(files)}，解析进程: {args.workers}")
+    start = time.time()
+    seen = set()
+    pending = []
+    totals = {"conversations": 0, "messages": 0}
+
+    def _write(chunk):
+        if semantic is not None:
+            semantic.bulk_ingest(
+                ((uid, messages_from_dict(msgs), datetime.fromisoformat(ts) if ts else None) for uid, ts, msgs in chunk),
+                batch_size=args.batch_size, checkpoint_path=ckpt['semantic'])
+        if time_memory is not None:
+            time_memory.bulk_store_original(
+                args.ee_name,
+                ((uid, msgs, datetime.fromisoformat(ts) if ts else None) for uid, ts, msgs in chunk),
+                checkpoint_path=ckpt['time'])
+        totals["conversations"] += len(chunk)
+        totals["messages"] += sum(len(msgs) for _, _, msgs in chunk)
+        elapsed = max(time.time() - start, 1e-6)
+        print(f"已写入 {totals['conversations']} 段对话 / {totals['messages']} 条消息，"
+              f"{totals['messages'] / elapsed:.0f} 条/秒")
+
+    with Pool(processes=max(1, args.workers)) as pool:
+        for done_files, conversations in enumerate(pool.imap(parse_archive_file, files), start=1):
+            for uid, ts, msgs in conversations:
+                # 同一次会话同时存在于会话归档与追加日志中
+                if uid in seen or not msgs:
+                    continue
+                seen.add(uid)
+                pending.append((uid, ts, msgs))
+            if len(pending) >= args.chunk:
+                _write(pending)
+                pending = []
+            if done_files % 50 == 0:
+                print(f"已解析 {done_files}/{len(files)} 个归档文件")
+    if pending:
+        _write(pending)
+    print(f"完成，用时 {time.time() - start:.1f} 秒")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())